@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Measure collection and migration throughput against local stand-in servers.
+
+A synthetic Gallery tree is written to a temporary directory and served over HTTP,
+Piwigo is replaced by a fake ws.php with configurable latency, and the migration
+database is a SQLite file given as DATABASE_URL. Both scripts then run in this process and their throughput
+is reported.
+
+Usage: ./benchmarks/bench_end_to_end.py [--depth 2] [--fanout 3] [--photos 20]
+       [--photo-size 200] [--latency 20] [--workers 4] [--local] [--keep]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from synthetic_gallery import write_gallery_tree
+from fake_piwigo import FakePiwigo
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_directory(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def run(main, argv):
+    sys.argv = argv
+    start = time.perf_counter()
+    main()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of collection and migration")
+    parser.add_argument('--depth', type=int, default=2, help="Levels of sub-albums below the root album")
+    parser.add_argument('--fanout', type=int, default=3, help="Sub-albums per album")
+    parser.add_argument('--photos', type=int, default=20, help="Photos per album")
+    parser.add_argument('--photo-size', type=int, default=200, help="Size of each photo in KB")
+    parser.add_argument('--latency', type=float, default=20, help="Milliseconds the fake ws.php waits before answering")
+    parser.add_argument('--workers', type=int, default=4, help="Migration worker threads")
+    parser.add_argument('--local', action='store_true', help="Read the Gallery tree from disk instead of over HTTP")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary directory")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gallery-bench-')
+    albums_dir = os.path.join(workdir, 'albums')
+    albums, photos = write_gallery_tree(albums_dir, 'bench', options.depth, options.fanout, options.photos,
+                                        options.photo_size * 1024, random.Random(0))
+    total_mb = photos * options.photo_size / 1024
+    print(f"Gallery: {albums} albums, {photos} photos, {total_mb:.1f} MB in {workdir}")
+
+    piwigo = FakePiwigo(latency=options.latency / 1000).start()
+    db_path = os.path.join(workdir, 'migration.db')
+    # The scripts read their configuration when they are imported
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{db_path}",
+        'PIWIGO_API_URL': piwigo.url,
+        'PIWIGO_USERNAME': 'bench',
+        'PIWIGO_PASSWORD': 'bench',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+        'PROGRESS_INTERVAL': os.getenv('PROGRESS_INTERVAL', '3600'),
+    })
+    if options.local:
+        os.environ['GALLERY_ALBUMS_DIR'] = albums_dir
+    else:
+        os.environ['GALLERY_BASE_URL'] = serve_directory(albums_dir)
+    os.chdir(workdir)  # Downloads go to ./migration
+
+    try:
+        import collect_gallery_meta_data
+        elapsed = run(collect_gallery_meta_data.main, ['collect_gallery_meta_data.py', 'bench'])
+        print(f"collect: {elapsed:8.2f} s {albums / elapsed:8.1f} albums/s {photos / elapsed:8.1f} photos/s")
+        collect_gallery_meta_data.engine.dispose()
+
+        import execute_migration
+        elapsed = run(execute_migration.main, ['execute_migration.py', '--workers', str(options.workers), 'bench'])
+        uploaded = piwigo.calls.get('pwg.images.addSimple', 0)
+        print(f"migrate: {elapsed:8.2f} s {uploaded / elapsed:8.1f} photos/s "
+              f"{piwigo.bytes_received / elapsed / 1024 / 1024:8.1f} MB/s uploaded "
+              f"({uploaded} of {photos} photos, {piwigo.calls.get('pwg.categories.add', 0)} albums)")
+    finally:
+        piwigo.shutdown()
+        if not options.keep:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Compare the streaming photos.dat parser with a full phpserialize.loads.
+
+Usage: ./benchmarks/bench_parse_photos_dat.py [photo_count ...]
+"""
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+import phpserialize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gallery_data import iter_serialized_array
+from synthetic_gallery import photos_dat
+
+def object_hook(name, obj):
+    return {key: value for key, value in obj.items()}
+
+def parse_loads(data):
+    # The pre-streaming path: decode everything, then walk the dict
+    return sum(1 for _ in phpserialize.loads(data, decode_strings=True, object_hook=object_hook).items())
+
+def parse_streaming(data):
+    return sum(1 for _ in iter_serialized_array(data, object_hook))
+
+def measure(parse, data):
+    start = time.perf_counter()
+    count = parse(data)
+    elapsed = time.perf_counter() - start
+    # Tracing slows parsing down a lot, so memory is measured in a second run
+    tracemalloc.start()
+    parse(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, elapsed, peak
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    for count in counts:
+        data = photos_dat([f"photo{i}" for i in range(count)], rng=random.Random(count))
+        reference = phpserialize.loads(data, decode_strings=True, object_hook=object_hook)
+        assert dict(iter_serialized_array(data, object_hook)) == reference, "parsers disagree"
+        print(f"{count} items, {len(data) / 1024 / 1024:.1f} MB photos.dat")
+        for label, parse in (('phpserialize.loads', parse_loads), ('streaming', parse_streaming)):
+            items, elapsed, peak = measure(parse, data)
+            print(f"  {label:<20} {elapsed:8.3f} s {items / elapsed:10.0f} items/s  peak {peak / 1024 / 1024:7.1f} MB")
+
+if __name__ == "__main__":
+    main()
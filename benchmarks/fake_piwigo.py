@@ -0,0 +1,102 @@
+"""A stand-in for Piwigo's ws.php, enough for execute_migration.py to run against.
+
+Implements pwg.session.login, pwg.categories.add and pwg.images.addSimple (plus the
+other methods the migration may call, answered with an empty success) and sleeps
+``latency`` seconds before every answer to imitate a remote server.
+"""
+
+import json
+import time
+import hashlib
+import itertools
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+class FakePiwigo(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0):
+        super().__init__(address, FakePiwigoHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.sessions = set()
+        self.calls = {}
+        self.images = {}  # md5sum -> image id
+        self.bytes_received = 0
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/ws.php"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class FakePiwigoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_fields(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/'):
+            message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            fields = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                      for part in message.iter_parts()}
+            return len(body), {name: value if name == 'image' else value.decode() for name, value in fields.items()}
+        return len(body), {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    def do_POST(self):
+        server = self.server
+        size, fields = self.read_fields()
+        method = fields.get('method')
+        response_format = parse_qs(urlparse(self.path).query).get('format', ['rest'])[0]
+        time.sleep(server.latency)
+        session_id = None
+        with server.lock:
+            server.calls[method] = server.calls.get(method, 0) + 1
+            server.bytes_received += size
+            cookie = (self.headers.get('Cookie') or '').replace('pwg_id=', '')
+            if method == 'pwg.session.login':
+                session_id = str(next(server.ids))
+                server.sessions.add(session_id)
+                result = None
+            elif cookie not in server.sessions:
+                return self.reply(response_format, None, error=(401, 'Access denied'))
+            elif method == 'pwg.categories.add':
+                result = {'id': next(server.ids)}
+            elif method in ('pwg.images.addSimple', 'pwg.images.add'):
+                image_id = next(server.ids)
+                if 'image' in fields:
+                    server.images[hashlib.md5(fields['image']).hexdigest()] = image_id
+                result = {'image_id': image_id}
+            elif method == 'pwg.images.exist':
+                result = {md5sum: server.images.get(md5sum) for md5sum in fields.get('md5sum_list', '').split(',')}
+            else:
+                result = None
+        self.reply(response_format, result, session_id=session_id)
+
+    def reply(self, response_format, result, error=None, session_id=None):
+        if response_format == 'json':
+            if error:
+                body = json.dumps({'stat': 'fail', 'err': error[0], 'message': error[1]})
+            else:
+                body = json.dumps({'stat': 'ok', 'result': result})
+        elif error:
+            body = f'<rsp stat="fail"><err code="{error[0]}" msg="{error[1]}" /></rsp>'
+        else:
+            body = '<rsp stat="ok">' + ''.join(f"<{key}>{value}</{key}>" for key, value in (result or {}).items()) + '</rsp>'
+        data = body.encode()
+        self.send_response(200)
+        if session_id:
+            self.send_header('Set-Cookie', f"pwg_id={session_id}; path=/")
+        self.send_header('Content-Type', 'application/json' if response_format == 'json' else 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,64 @@
+"""Synthetic Gallery 1.x data for the benchmarks."""
+
+import os
+import random
+import phpserialize
+
+def photo_item(name, file_type='jpg', rng=random):
+    return phpserialize.phpobject('AlbumItem', {
+        'image': phpserialize.phpobject('Image', {'name': name, 'type': file_type,
+                                                  'raw_width': 3000, 'raw_height': 2000}),
+        'thumbnail': phpserialize.phpobject('Image', {'name': f"{name}.thumb", 'type': file_type}),
+        'caption': f"Kes\xe4loma {name}",
+        'hidden': False,
+        'highlight': None,
+        'uploadDate': 1100000000 + rng.randint(0, 10 ** 8),
+        'itemCaptureDate': {'year': '2004', 'mon': str(rng.randint(1, 12)), 'mday': str(rng.randint(1, 28)),
+                            'hours': '12', 'minutes': '30', 'seconds': '15'},
+        'extraFields': {'Description': 'Kuvaus ' * rng.randint(1, 20)},
+        'clicks': rng.randint(0, 500),
+        'keywords': '',
+        'comments': [],
+    })
+
+def album_item(name):
+    return phpserialize.phpobject('AlbumItem', {'image': None, 'isAlbumName': name})
+
+def photos_dat(photo_names, sub_album_names=(), rng=random):
+    """Serialize a photos.dat holding the given photos followed by the sub-albums."""
+    items = [photo_item(name, rng=rng) for name in photo_names]
+    items += [album_item(name) for name in sub_album_names]
+    return phpserialize.dumps(dict(enumerate(items)))
+
+def album_dat(name):
+    return phpserialize.dumps(phpserialize.phpobject('Album', {
+        'fields': {'name': name, 'title': f"Album {name}", 'description': f"Kuvia albumista {name}",
+                   'kuvausta': f"Kuvausta {name}"},
+    }))
+
+def write_gallery_tree(albums_dir, root_name, depth, fanout, photos_per_album, photo_size, rng=random):
+    """Write a Gallery albums/ directory with a tree of albums below root_name.
+
+    Like Gallery 1.x, every album is a directory directly under albums_dir, holding its
+    album.dat, photos.dat and photo_size bytes of random data per photo. Returns the
+    number of albums and photos written.
+    """
+    albums = photos = 0
+    pending = [(root_name, depth)]
+    while pending:
+        name, levels_below = pending.pop()
+        album_dir = os.path.join(albums_dir, name)
+        os.makedirs(album_dir, exist_ok=True)
+        photo_names = [f"{name}_{index}" for index in range(photos_per_album)]
+        sub_album_names = [f"{name}_a{index}" for index in range(fanout)] if levels_below else []
+        for photo_name in photo_names:
+            with open(os.path.join(album_dir, f"{photo_name}.jpg"), 'wb') as f:
+                f.write(b'\xff\xd8' + rng.randbytes(max(0, photo_size - 2)))
+        with open(os.path.join(album_dir, 'photos.dat'), 'wb') as f:
+            f.write(photos_dat(photo_names, sub_album_names, rng))
+        with open(os.path.join(album_dir, 'album.dat'), 'wb') as f:
+            f.write(album_dat(name))
+        albums += 1
+        photos += len(photo_names)
+        pending += [(sub_album, levels_below - 1) for sub_album in sub_album_names]
+    return albums, photos
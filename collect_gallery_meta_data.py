@@ -1,39 +1,51 @@
 #!/usr/bin/env python
 
-import requests
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime
+import argparse
+import asyncio
+import hashlib
+import itertools
+from sqlalchemy import insert, Boolean, Column, Integer, String, Text, ForeignKey, DateTime, Index
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from urllib.parse import quote
 import logging
 import phpserialize
-import re
 import sys, os
 from datetime import datetime
+from gallery_data import decode_chars, iter_serialized_array
+from gallery_source import gallery_base_url, is_local, local_path, read_local_data
+from request_scheduler import RequestScheduler, checked_get
+from metrics import metrics, ProgressReporter
+from migration_db import create_db_engine
 
 
 # Set up logging
 LOG_MSG_FORMAT = ('%(asctime)s,%(msecs)03d %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
 LOG_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 logFormatter = logging.Formatter(LOG_MSG_FORMAT, LOG_DATE_FORMAT)
-logging.basicConfig(level=logging.DEBUG, format=LOG_MSG_FORMAT, datefmt=LOG_DATE_FORMAT)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format=LOG_MSG_FORMAT, datefmt=LOG_DATE_FORMAT)
 logger = logging.getLogger(__name__)
 
 # Constants
-GALLERY_BASE_URL = os.getenv('GALLERY_BASE_URL', None)
+GALLERY_BASE_URL = gallery_base_url()
 DATABASE_URL = os.getenv('DATABASE_URL', None)
+COLLECT_BATCH_SIZE = int(os.getenv('COLLECT_BATCH_SIZE', 500))
+COLLECT_CONCURRENCY = int(os.getenv('COLLECT_CONCURRENCY', 8))
 if GALLERY_BASE_URL is None or DATABASE_URL is None:
-    logger.error("GALLERY_BASE_URL and DATABASE_URL environment variables need to be set.")
+    logger.error("GALLERY_BASE_URL (or GALLERY_ALBUMS_DIR) and DATABASE_URL environment variables need to be set.")
     sys.exit(1)
 
 Base = declarative_base()
 try:
-    engine = create_engine(DATABASE_URL)
+    engine = create_db_engine(DATABASE_URL)
 except Exception as e:
     logger.error(f"Error creating database engine: {e}")
     sys.exit(1)
 
+gallery_scheduler = RequestScheduler('Gallery', COLLECT_CONCURRENCY)
+
 Session = sessionmaker(bind=engine)
 session = Session()
+pending_photos = []
 
 class Album(Base):
     __tablename__ = 'albums'
@@ -44,6 +56,11 @@ class Album(Base):
     title = Column(String(255), nullable=True)
     caption = Column(Text, nullable=True)
     description = Column(Text, nullable=True)
+    created = Column(Boolean, nullable=False, default=False)
+    migrated = Column(Boolean, nullable=False, default=False)
+    piwigo_id = Column(Integer, nullable=True)  # Piwigo category id, recorded by execute_migration.py
+    claimed_by = Column(String(255), nullable=True)  # Migration worker holding the album, with its lease
+    lease_expires = Column(DateTime, nullable=True)
     subalbums = relationship('Album', backref='parent', remote_side=[id])
     photos = relationship('Photo', backref='album')
 
@@ -58,44 +75,75 @@ class Photo(Base):
     description = Column(Text, nullable=True)
     url = Column(String(255), nullable=True)
     meta = Column(Text, nullable=True)
+    downloaded = Column(Boolean, nullable=False, default=False)  # Set by execute_migration.py
+    uploaded = Column(Boolean, nullable=False, default=False)
+    md5sum = Column(String(32), nullable=True)  # Of the file Piwigo got, recorded with uploaded
+    # execute_migration.py lists the photos of an album that are not uploaded yet
+    __table_args__ = (Index('ix_photos_album_uploaded', 'album_id', 'uploaded'),)
+
+class DatFile(Base):
+    # Validators of every fetched photos.dat/album.dat, used by incremental collection
+    __tablename__ = 'dat_files'
+    url = Column(String(512), primary_key=True)
+    etag = Column(String(255), nullable=True)
+    last_modified = Column(String(64), nullable=True)
+    content_hash = Column(String(40), nullable=True)
+    fetched_at = Column(DateTime, default=datetime.utcnow)
 
 def create_tables():
     Base.metadata.create_all(engine)
 
-def decode_chars(text):
-    if text is None:
-        return ''
-    char_map = {
-        '\\xC4': 'Ä',
-        '\\xE4': 'ä',
-        '\\xD6': 'Ö',
-        '\\xF6': 'ö',
-        '\\xC5': 'Å',
-        '\\xE5': 'å',
-        '\udcc4': 'Ä',
-        '\udce4': 'ä',
-        '\udcd6': 'Ö',
-        '\udcf6': 'ö',
-        '\udcc5': 'Å',
-        '\udce5': 'å'
-    }
-    pattern = re.compile('|'.join(re.escape(key) for key in char_map.keys()))
-    decoded_text = pattern.sub(lambda x: char_map[x.group()], text)
-    return decoded_text
-
 def fetch_data(url):
-    logger.debug(f"Fetching data from URL: {url}")
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.content
+    data, _ = fetch_data_conditional(url, None)
+    return data
+
+def fetch_data_conditional(url, cached):
+    """Fetch url unless it is unchanged since the cached (etag, last_modified, content_hash).
+
+    Returns (data, validators) where data is None if the file has not changed, either
+    because the server answered 304 or because its content hash is the same.
+    """
+    with metrics.stage('fetch'):
+        data, validators = fetch_changed_data(url, cached)
+    if data is not None:
+        metrics.count('bytes_fetched', len(data))
+    return data, validators
+
+def fetch_changed_data(url, cached):
+    etag, last_modified, content_hash = cached or (None, None, None)
+    if is_local(url):
+        # The modification time stands in for Last-Modified on local files
+        new_etag, new_last_modified = None, str(os.stat(local_path(url)).st_mtime_ns)
+        if cached and new_last_modified == last_modified:
+            return None, cached
+        data = read_local_data(url)
+    else:
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        logger.debug("Fetching data from URL: %s", url)
+        response = gallery_scheduler.call(checked_get, url, headers=headers)
+        if cached and response.status_code == 304:
+            return None, cached
+        response.raise_for_status()
+        data = response.content
+        new_etag, new_last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+    new_hash = hashlib.sha1(data).hexdigest()
+    validators = (new_etag, new_last_modified, new_hash)
+    if cached and new_hash == content_hash:
+        return None, validators
+    return data, validators
 
 def object_hook(name, obj):
     return {key: value for key, value in obj.items()}
 
 def parse_album_data(data):
     try:
-        album_data = phpserialize.loads(data, decode_strings=True, object_hook=object_hook)
-        logger.debug(f"Parsed album data: {album_data}")
+        with metrics.stage('parse'):
+            album_data = phpserialize.loads(data, decode_strings=True, object_hook=object_hook)
+        logger.debug("Parsed album data: %s", album_data)
         fields = album_data.get('fields', {})
         title = decode_chars(fields.get('title', ''))
         description = decode_chars(fields.get('description', ''))
@@ -105,145 +153,285 @@ def parse_album_data(data):
         logger.error(f"Error deserializing album data: {e}")
         return None, None, None
 
-def parse_photos_data(data):
-    def object_hook(name, obj):
-        return {key: value for key, value in obj.items()}
+def parse_photo_item(item):
+    if item['image'] is None:  # This is an album, its album.dat is fetched by the crawler
+        album_name = item['isAlbumName']
+        logger.debug("Detected sub-album with name: %s", album_name)
+        return {'name': album_name, 'is_album': True}
+    # This is a photo
+    caption_raw = item.get('caption', '')
+    description_raw = item['extraFields'].get('Description', '') if 'extraFields' in item else ''
+    caption = decode_chars(caption_raw)
+    description = decode_chars(description_raw)
+    raw_uploaddate = item.get('uploadDate', 0)
+    uploaddate = datetime.utcfromtimestamp(raw_uploaddate).strftime('%Y-%m-%d %H:%M:%S')
+    raw_capturedate = item.get('itemCaptureDate', datetime.utcnow())
+    capturedt = datetime(int(raw_capturedate['year']),
+                         int(raw_capturedate['mon']),
+                         int(raw_capturedate['mday']),
+                         int(raw_capturedate['hours']),
+                         int(raw_capturedate['minutes']),
+                         int(raw_capturedate['seconds']))
+    capturedate = capturedt.strftime('%Y-%m-%d %H:%M:%S')
+    url = GALLERY_BASE_URL + '/' + item['image']['name'] + '.' + item['image']['type']
+    logger.debug("itemCaptureDate: %s, uploadDate: %s", capturedate, uploaddate)
+    logger.debug("Raw caption: %s, Raw description: %s", caption_raw, description_raw)
+    logger.debug("Decoded caption: %s, Decoded description: %s", caption, description)
+    return {
+        'name': item['image']['name'] + '.' + item['image']['type'],
+        'is_album': False,
+        'capturedate': capturedate,
+        'uploaddate': uploaddate,
+        'caption': caption,
+        'description': description,
+        'url': url
+    }
 
-    items = []
+def iter_photos_data(data):
+    """Yield the sub-album and photo items of a photos.dat one at a time.
+
+    The serialized array is decoded entry by entry, so the caller can store the first
+    photos while the rest of a large file is still unparsed. Items before damage in the
+    file are still yielded.
+    """
     try:
-        data_dict = phpserialize.loads(data, decode_strings=True, object_hook=object_hook)
-        logger.debug(f"Parsed data_dict: {data_dict}")
-        for idx, item in data_dict.items():
+        for idx, item in iter_serialized_array(data, object_hook):
             try:
-                logger.debug(f"Processing item {idx}: {item}")
-                if item['image'] is None:  # This is an album
-                    album_dat_url = f"{GALLERY_BASE_URL}/{item['isAlbumName']}/album.dat"
-                    album_data = fetch_data(album_dat_url)
-                    title, caption, description = parse_album_data(album_data)
-                    logger.debug(f"Album data: title: {title}, caption: {caption}, description: {description}")
-                    album_name = item['isAlbumName']
-                    logger.debug(f"Detected sub-album with name: {album_name},\
-                                 caption: {caption}, title: {title}, description: {description}")
-                    items.append({'name': album_name, 'is_album': True,\
-                                  'caption': caption, 'title': title, 'description': description})
-                else:  # This is a photo
-                    caption_raw = item.get('caption', '')
-                    description_raw = item['extraFields'].get('Description', '') if 'extraFields' in item else ''
-                    caption = decode_chars(caption_raw)
-                    description = decode_chars(description_raw)
-                    raw_uploaddate = item.get('uploadDate', 0)
-                    uploaddate = datetime.utcfromtimestamp(raw_uploaddate).strftime('%Y-%m-%d %H:%M:%S')
-                    raw_capturedate = item.get('itemCaptureDate', datetime.utcnow())
-                    capturedt = datetime(int(raw_capturedate['year']),
-                                         int(raw_capturedate['mon']),
-                                         int(raw_capturedate['mday']),
-                                         int(raw_capturedate['hours']),
-                                         int(raw_capturedate['minutes']),
-                                         int(raw_capturedate['seconds']))
-                    capturedate = capturedt.strftime('%Y-%m-%d %H:%M:%S')
-                    url = GALLERY_BASE_URL + '/' + item['image']['name'] + '.' + item['image']['type']
-                    logger.debug(f"itemCaptureDate: {capturedate}, uploadDate: {uploaddate}")
-                    logger.debug(f"Raw caption: {caption_raw}, Raw description: {description_raw}")
-                    logger.debug(f"Decoded caption: {caption}, Decoded description: {description}")
-                    items.append({
-                        'name': item['image']['name'] + '.' + item['image']['type'],
-                        'is_album': False,
-                        'capturedate': capturedate,
-                        'uploaddate': uploaddate,
-                        'caption': caption,
-                        'description': description,
-                        'url': url
-                    })
-                    logger.debug(f"capturedate: {capturedate} uploaddate: {uploaddate} caption: {caption} description: {description} url: {url}")
+                logger.debug("Processing item %s", idx)
+                parsed = parse_photo_item(item)
             except Exception as e:
                 logger.error(f"Error processing item: {item}")
                 logger.error(f"Exception: {e}")
+                continue
+            yield parsed
     except ValueError as e:
         logger.error(f"Error deserializing data: {e}")
-        logger.error(f"Data: {data[:1000]}...")  # Log the first 1000 characters of the data for debugging
+        logger.error(f"Data: {bytes(data[:1000])}...")  # Log the first 1000 characters of the data for debugging
+
+async def iter_photo_batches(data):
+    """Yield the items of a photos.dat in lists of up to COLLECT_BATCH_SIZE.
 
-    return items
+    Each batch is parsed in a worker thread, off the event loop, while the caller stores
+    the one before it, so storing starts after the first batch and a large file is never
+    held parsed in full.
+    """
+    items = iter_photos_data(data)
+
+    def take():
+        return list(itertools.islice(items, COLLECT_BATCH_SIZE))
+
+    pending = asyncio.ensure_future(asyncio.to_thread(take))
+    try:
+        while True:
+            batch = await pending
+            if not batch:
+                return
+            pending = asyncio.ensure_future(asyncio.to_thread(take))
+            yield batch
+    finally:
+        pending.cancel()
 
 def insert_album(name, parent_id, meta, title, caption, description):
     album = Album(name=name, parent_id=parent_id, meta=meta, title=title, caption=caption, description=description)
-    session.add(album)
     try:
-        session.commit()
+        # Flushing in a savepoint assigns the id used as parent_id, and a failure loses this
+        # album only; the row is committed with the next photo batch
+        with session.begin_nested():
+            session.add(album)
+        metrics.count('albums')
         logger.info(f"Inserted album: {name} with parent_id: {parent_id}")
         return album.id
     except Exception as e:
-        session.rollback()
-        logger.error(f"Error inserting album: {e}")
+        logger.error(f"Error inserting album {name}: {e}")
+
+def parse_timestamp(value):
+    # parse_photo_item keeps dates as strings, which is also how they appear in meta;
+    # DateTime columns want datetime objects, and SQLite rejects anything else
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S') if isinstance(value, str) else value
 
 def insert_photo(album_id, filename, caption, description, url, meta, capturedate, uploaddate):
     caption = caption.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
     description = description.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
-    photo = Photo(album_id=album_id, filename=filename, caption=caption,
-                  description=description, url=url, meta=meta, capturedate=capturedate, uploaddate=uploaddate)
-    session.add(photo)
-    try:
-        session.commit()
-        logger.info(f"Inserted photo: {filename} in album_id: {album_id}")
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Error inserting photo: {e}")
+    pending_photos.append({'album_id': album_id, 'filename': filename, 'caption': caption,
+                           'description': description, 'url': url, 'meta': meta,
+                           'capturedate': parse_timestamp(capturedate), 'uploaddate': parse_timestamp(uploaddate)})
+    metrics.count('photos')
+    if len(pending_photos) >= COLLECT_BATCH_SIZE:
+        flush_photos()
+
+def flush_photos():
+    """Write the buffered photos with one multi-row insert and commit the transaction.
+
+    The insert runs in a savepoint. If it fails, the photos are inserted one at a time,
+    each in a savepoint of its own, so a bad row loses only itself and never the albums
+    flushed since the last commit, whose ids other rows already refer to.
+    """
+    inserted = len(pending_photos)
+    with metrics.stage('db_commit'):
+        if pending_photos:
+            try:
+                with session.begin_nested():
+                    session.execute(insert(Photo), pending_photos)
+            except Exception as e:
+                logger.warning(f"Error inserting {len(pending_photos)} photos at once, inserting them one by one: {e}")
+                for photo in pending_photos:
+                    try:
+                        with session.begin_nested():
+                            session.execute(insert(Photo), [photo])
+                    except Exception as e:
+                        inserted -= 1
+                        logger.error(f"Error inserting photo {photo['filename']} of album_id {photo['album_id']}: {e}")
+        try:
+            session.commit()
+            logger.info(f"Inserted {inserted} photos")
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error committing {inserted} photos: {e}")
+    pending_photos.clear()
 
-def process_subalbum(album_name, parent_id):
+def find_album(name, parent_id):
+    return session.query(Album).filter_by(name=name, parent_id=parent_id).first()
+
+def update_album(album, title, caption, description):
+    album.title, album.caption, album.description = title, caption, description
+    logger.info(f"Updated album: {album.name}")
+
+def update_photo(photo, item):
+    photo.caption = item['caption'].encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
+    photo.description = item['description'].encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
+    photo.url, photo.meta = item['url'], str(item)
+    photo.capturedate, photo.uploaddate = parse_timestamp(item['capturedate']), parse_timestamp(item['uploaddate'])
+    metrics.count('photos_updated')
+    logger.info(f"Updated photo: {photo.filename} in album_id: {photo.album_id}")
+
+def record_dat_file(url, validators):
+    etag, last_modified, content_hash = validators
+    session.merge(DatFile(url=url, etag=etag, last_modified=last_modified,
+                          content_hash=content_hash, fetched_at=datetime.utcnow()))
+
+def load_dat_cache():
+    return {dat_file.url: (dat_file.etag, dat_file.last_modified, dat_file.content_hash)
+            for dat_file in session.query(DatFile)}
+
+async def fetch_album(album_name, parent_id, semaphore, dat_cache):
+    """Fetch and parse album.dat and photos.dat of one album.
+
+    Fetching and parsing run in worker threads, at most ``semaphore`` requests at a time.
+    Each result is (url, validators, data), with None as data when the file is unchanged
+    since the validators in dat_cache. album.dat comes parsed; photos.dat comes raw and is
+    parsed batch by batch while it is stored. Fetch errors are returned in place of the
+    result so the writer can report them.
+    """
     encoded_album_name = quote(album_name)
-    photos_url = f"{GALLERY_BASE_URL}/{encoded_album_name}/photos.dat"
+
+    async def fetch(filename, parse=None):
+        url = f"{GALLERY_BASE_URL}/{encoded_album_name}/{filename}"
+        async with semaphore:
+            data, validators = await asyncio.to_thread(fetch_data_conditional, url, dat_cache.get(url))
+        if parse is not None and data is not None:
+            data = await asyncio.to_thread(parse, data)
+        return url, validators, data
+
+    album_result, photos_result = await asyncio.gather(fetch('album.dat', parse_album_data),
+                                                       fetch('photos.dat'),
+                                                       return_exceptions=True)
+    return album_name, parent_id, album_result, photos_result
+
+async def store_album(album_name, parent_id, album_result, photos_result, incremental=False):
+    """Write a crawled album and its photos and return (name, album_id) for each sub-album.
+
+    In incremental mode existing albums and photos are updated in place and only new
+    photos are inserted; an unchanged photos.dat is skipped entirely.
+    """
+    if isinstance(album_result, Exception):
+        logger.error(f"Could not fetch album.dat for album {album_name}: {album_result}")
+        return []
+    album_url, album_validators, album_fields = album_result
+    album = find_album(album_name, parent_id) if incremental else None
+    if album is None:
+        title, caption, description = album_fields
+        album_id = insert_album(album_name, parent_id, album_name, title, caption, description)
+        if album_id is None:
+            return []
+    else:
+        album_id = album.id
+        if album_fields is not None:
+            update_album(album, *album_fields)
+    record_dat_file(album_url, album_validators)
+    if isinstance(photos_result, Exception):
+        logger.warning(f"No photos.dat found for album {album_name}: {photos_result}")
+        return []
+    photos_url, photos_validators, photos_data = photos_result
+    record_dat_file(photos_url, photos_validators)
+
+    if photos_data is None:
+        metrics.count('albums_unchanged')
+        logger.info(f"Album {album_name} is unchanged, skipping its photos")
+        return [(sub_album.name, album_id) for sub_album in session.query(Album).filter_by(parent_id=album_id)]
+    existing = {photo.filename: photo for photo in session.query(Photo).filter_by(album_id=album_id)} \
+        if album is not None else {}
+    sub_albums = []
     try:
-        photos_data = fetch_data(photos_url)
-        photos = parse_photos_data(photos_data)
-        for photo in photos:
-            if not photo['is_album']:
-                insert_photo(parent_id, photo['name'], photo['caption'],
-                             photo['description'], photo['url'],
-                             str(photo), photo['capturedate'], photo['uploaddate'])
-    except requests.HTTPError as e:
-        logger.warning(f"No photos.dat found for album {album_name}: {e}")
+        async for batch in iter_photo_batches(photos_data):
+            for item in batch:
+                if item['is_album']:
+                    sub_albums.append((item['name'], album_id))
+                elif item['name'] not in existing:
+                    insert_photo(album_id, item['name'], item['caption'], item['description'], item['url'],
+                                 str(item), item['capturedate'], item['uploaddate'])
+                elif existing[item['name']].meta != str(item):
+                    update_photo(existing[item['name']], item)
     except Exception as e:
-        logger.error(f"Unexpected error processing album {album_name}: {e}")
+        # Keeps what came before the damage, and the rest of the tree, of a broken photos.dat
+        logger.error(f"Error storing photos of album {album_name}: {e}")
+    return sub_albums
+
+async def crawl_album_tree(root_album, incremental=False, concurrency=COLLECT_CONCURRENCY):
+    """Collect root_album and every album below it, whatever the depth.
+
+    Albums are fetched breadth-first with up to ``concurrency`` requests in flight. Each
+    album is written as soon as its data arrives, which gives it the id its sub-albums
+    need as parent_id before they are scheduled. In incremental mode albums already in
+    the database are fetched with conditional requests.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    dat_cache = load_dat_cache() if incremental else {}
+
+    def schedule(album_name, parent_id):
+        # Only albums already in the database can skip an unchanged .dat file
+        known = incremental and find_album(album_name, parent_id) is not None
+        return asyncio.create_task(fetch_album(album_name, parent_id, semaphore, dat_cache if known else {}))
+
+    seen = {root_album}
+    pending = {schedule(root_album, None)}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            for sub_album_name, album_id in await store_album(*task.result(), incremental=incremental):
+                if sub_album_name in seen:
+                    logger.warning(f"Album {sub_album_name} is referenced more than once, skipping")
+                    continue
+                seen.add(sub_album_name)
+                pending.add(schedule(sub_album_name, album_id))
 
-def process_root_album(root_album):
-    encoded_root_album = quote(str(root_album))
-    root_album_photos_url = f"{GALLERY_BASE_URL}/{encoded_root_album}/photos.dat"
-    root_album_dat_url = f"{GALLERY_BASE_URL}/{encoded_root_album}/album.dat"
+def process_root_album(root_album, incremental=False):
     try:
-        root_album_data = fetch_data(root_album_dat_url)
-        title, caption, description = parse_album_data(root_album_data)
-        root_album_id = insert_album(str(root_album), None, str(root_album),
-                                     title=title, caption=caption,
-                                     description=description)
-        root_album_photos_data = fetch_data(root_album_photos_url)
-        root_album_photos = parse_photos_data(root_album_photos_data)
-
-        for photo in root_album_photos:
-            if photo['is_album']:
-                sub_album_name = photo['name']
-                title = photo['title']
-                caption = photo['caption']
-                description = photo['description']
-                sub_album_id = insert_album(sub_album_name, root_album_id, sub_album_name, title, caption, description)
-                process_subalbum(sub_album_name, sub_album_id)
-            else:
-                insert_photo(root_album_id, photo['name'], photo['caption'], photo['description'], photo['url'], str(photo), photo['capturedate'], photo['uploaddate'])
-    except requests.HTTPError as e:
-        logger.warning(f"No photos.dat found for root_album {root_album}: {e}")
+        asyncio.run(crawl_album_tree(str(root_album), incremental))
     except Exception as e:
         logger.error(f"Unexpected error processing root_album {root_album}: {e}")
 
 def main():
-    create_tables()
-
-    if len(sys.argv) < 2:
-        logger.error("[root_album] not provided. Usage: ./get_album_data.py [root_album]")
-        sys.exit(1)
-
-    root_album = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Collect Gallery 1.x album metadata")
+    parser.add_argument('root_album', help="Gallery root album to collect")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only fetch changed .dat files and upsert new or modified photos")
+    args = parser.parse_args()
 
-    process_root_album(root_album)
+    create_tables()
+    with ProgressReporter('photos', 'bytes_fetched', prefix='gallery_collect'):
+        process_root_album(args.root_album, args.incremental)
+        flush_photos()
     session.close()
 
 if __name__ == "__main__":
     main()
-
@@ -1,20 +1,78 @@
 #!/usr/bin/env python
 
 import os, sys
+import socket
+import time
+import argparse
+import base64
+import hashlib
+import math
+import threading
+import queue
+import multiprocessing
 import requests
 import logging
-import mysql.connector
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
-from xml.etree import ElementTree
 import re
+from datetime import datetime, timedelta
+from gallery_source import gallery_base_url, is_local, local_path, read_local_data, copy_local_image
+from piwigo_client import PiwigoClient, PiwigoError
+from piwigo_direct import DirectImporter
+from image_optimizer import pillow_available, optimize_image, sniff_mime_type
+from request_scheduler import RequestScheduler, checked_get
+from migration_db import create_pool, set_photo_flag, record_uploads
+from metrics import METRICS_FILE, metrics, ProgressReporter, process_metrics_file
 
 # Constants
-GALLERY_BASE_URL =  os.getenv('GALLERY_BASE_URL', None)
+GALLERY_BASE_URL = gallery_base_url()
 PIWIGO_API_URL = os.getenv('PIWIGO_API_URL', None) # 'http://[piwigo_host]/piwigo/ws.php'
 PIWIGO_USERNAME = os.getenv('PIWIGO_USERNAME', None)
 PIWIGO_PASSWORD = os.getenv('PIWIGO_PASSWORD', None)
 DOWNLOAD_DIR = "migration"
+OPTIMIZED_DIR = "optimized"  # Optimized copies, kept apart so downloads are never overwritten
+MIGRATION_WORKERS = int(os.getenv('MIGRATION_WORKERS', 4))
+MIGRATION_DEDUP = os.getenv('MIGRATION_DEDUP', 'false').lower() in ('1', 'true', 'yes')
+DEDUP_BATCH_SIZE = int(os.getenv('DEDUP_BATCH_SIZE', 50))
+BATCH_WAIT = 1.0  # Seconds to wait for a dedup, direct import or flag batch to fill up
+MIGRATION_DELETE_UPLOADED = os.getenv('MIGRATION_DELETE_UPLOADED', 'false').lower() in ('1', 'true', 'yes')
+MIGRATION_DISK_BUDGET_MB = int(os.getenv('MIGRATION_DISK_BUDGET_MB', 0))
+PHOTO_PAGE_SIZE = int(os.getenv('PHOTO_PAGE_SIZE', 500))  # Photos read from the migration database per query
+# Only what the migration uses; meta holds a copy of the whole Gallery item
+PHOTO_COLUMNS = "id, filename, caption, description, capturedate, uploaddate, downloaded"
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+DOWNLOAD_TIMEOUT = int(os.getenv('DOWNLOAD_TIMEOUT', 60))
+# Upper bounds for the adaptive number of requests in flight to each server
+GALLERY_MAX_CONCURRENCY = int(os.getenv('GALLERY_MAX_CONCURRENCY', 16))
+PIWIGO_MAX_CONCURRENCY = int(os.getenv('PIWIGO_MAX_CONCURRENCY', 16))
+# Files at least this large go through pwg.images.addChunk instead of pwg.images.addSimple
+PIWIGO_CHUNKED_UPLOAD_THRESHOLD = int(os.getenv('PIWIGO_CHUNKED_UPLOAD_THRESHOLD', 16 * 1024 * 1024))
+PIWIGO_CHUNK_SIZE = int(os.getenv('PIWIGO_CHUNK_SIZE', 2 * 1024 * 1024))
+PIWIGO_CHUNK_WORKERS = int(os.getenv('PIWIGO_CHUNK_WORKERS', 1))
+PIWIGO_CHUNK_RETRIES = int(os.getenv('PIWIGO_CHUNK_RETRIES', 3))
+# 'ws' uploads through ws.php, 'direct' writes into PIWIGO_ROOT_DIR and the Piwigo database
+MIGRATION_BACKEND = os.getenv('MIGRATION_BACKEND', 'ws')
+PIWIGO_ROOT_DIR = os.getenv('PIWIGO_ROOT_DIR', None) # '/var/www/piwigo'
+PW_DB_PREFIX = os.getenv('PW_DB_PREFIX', 'piwigo_')
+PIWIGO_ADDED_BY = int(os.getenv('PIWIGO_ADDED_BY', 1)) # Piwigo user id recorded as the uploader
+DIRECT_BATCH_SIZE = int(os.getenv('DIRECT_BATCH_SIZE', 100))
+# With --claim, an album claimed by a worker that stops renewing it is free again after this long
+MIGRATION_LEASE_SECONDS = int(os.getenv('MIGRATION_LEASE_SECONDS', 300))
+CLAIM_POLL_SECONDS = int(os.getenv('CLAIM_POLL_SECONDS', 10))
+# With --verify, processes hashing photos and Piwigo albums (or photos to reset) per query
+VERIFY_PROCESSES = int(os.getenv('VERIFY_PROCESSES', os.cpu_count() or 1))
+VERIFY_BATCH_SIZE = int(os.getenv('VERIFY_BATCH_SIZE', 500))
+# With --optimize, photos are recompressed and scaled down to OPTIMIZE_MAX_DIMENSION pixels (0 = keep the size)
+MIGRATION_OPTIMIZE = os.getenv('MIGRATION_OPTIMIZE', 'false').lower() in ('1', 'true', 'yes')
+OPTIMIZE_MAX_DIMENSION = int(os.getenv('OPTIMIZE_MAX_DIMENSION', 0))
+OPTIMIZE_JPEG_QUALITY = int(os.getenv('OPTIMIZE_JPEG_QUALITY', 90))
+OPTIMIZE_STRIP_METADATA = os.getenv('OPTIMIZE_STRIP_METADATA', 'true').lower() in ('1', 'true', 'yes')
+OPTIMIZE_PROCESSES = int(os.getenv('OPTIMIZE_PROCESSES', os.cpu_count() or 1))
 
+# A SQLAlchemy URL, e.g. sqlite:////var/tmp/migration.db; without it MIG_DB_* are used
+DATABASE_URL = os.getenv('DATABASE_URL', None)
 DB_CONFIG = {
     'host': os.getenv('MIG_DB_HOST', None),
     'user': os.getenv('MIG_DB_USER', None),
@@ -22,6 +80,12 @@ DB_CONFIG = {
     'database': os.getenv('MIG_DB_NAME', None)
 }
 
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 4))
+# Migration database connections held at once: the album loop, which also writes the photo
+# flags, the photo listing and, with --claim, the lease renewal. mysql pools do not wait.
+MIGRATION_DB_CONNECTIONS = 3
+FLAG_BATCH_SIZE = int(os.getenv('FLAG_BATCH_SIZE', 50))  # Photo flags written per commit at most
+
 PW_DB_CONFIG = {
     'host': os.getenv('PW_DB_HOST', None),
     'user': os.getenv('PW_DB_USER', None),
@@ -34,265 +98,1138 @@ PW_DB_CONFIG = {
 LOG_MSG_FORMAT = ('%(asctime)s,%(msecs)03d %(levelname)s [%(filename)s:%(lineno)d] - %(message)s')
 LOG_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 logFormatter = logging.Formatter(LOG_MSG_FORMAT, LOG_DATE_FORMAT)
-logging.basicConfig(level=logging.DEBUG, format=LOG_MSG_FORMAT, datefmt=LOG_DATE_FORMAT)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format=LOG_MSG_FORMAT, datefmt=LOG_DATE_FORMAT)
 logger = logging.getLogger(__name__)
 
-session = requests.Session()
-
-def decode_chars(text):
-    if text is None:
-        return ''
-    char_map = {
-        '\\xC4': 'Ä',
-        '\\xE4': 'ä',
-        '\\xD6': 'Ö',
-        '\\xF6': 'ö',
-        '\\xC5': 'Å',
-        '\\xE5': 'å',
-        '\udcc4': 'Ä',
-        '\udce4': 'ä',
-        '\udcd6': 'Ö',
-        '\udcf6': 'ö',
-        '\udcc5': 'Å',
-        '\udce5': 'å'
-    }
-    pattern = re.compile('|'.join(re.escape(key) for key in char_map.keys()))
-    decoded_text = pattern.sub(lambda x: char_map[x.group()], text)
-    return decoded_text
+gallery_scheduler = RequestScheduler('Gallery', GALLERY_MAX_CONCURRENCY)
+piwigo = PiwigoClient(PIWIGO_API_URL, PIWIGO_USERNAME, PIWIGO_PASSWORD,
+                      scheduler=RequestScheduler('Piwigo', PIWIGO_MAX_CONCURRENCY))
+thread_local = threading.local()
+db_pools = {}
+db_pools_lock = threading.Lock()
+optimize_pool = None
+optimize_pool_lock = threading.Lock()
 
 def fetch_data(url):
-    logger.debug(f"Fetching data from URL: {url}")
-    response = requests.get(url)
-    response.raise_for_status()
+    if is_local(url):
+        return read_local_data(url)
+    logger.debug("Fetching data from URL: %s", url)
+    with metrics.stage('fetch'):
+        response = gallery_scheduler.call(checked_get, url)
+    metrics.count('bytes_fetched', len(response.content))
     return response.content  # Return raw bytes
 
-def piwigo_login():
-    data = {
-        'method': 'pwg.session.login',
-        'username': PIWIGO_USERNAME,
-        'password': PIWIGO_PASSWORD,
-    }
-    response = session.post(PIWIGO_API_URL, data=data)
-    logger.debug(f"Login response status code: {response.status_code}")
-    logger.debug(f"Login response text: {response.text}")
-    result = ElementTree.fromstring(response.content)
-    if result.get('stat') == 'ok':
-        logger.debug("Logged in to Piwigo")
-    else:
-        raise Exception("Failed to log in to Piwigo")
+def get_http_session():
+    # Each worker thread keeps its own keep-alive session for Gallery downloads
+    http_session = getattr(thread_local, 'session', None)
+    if http_session is None:
+        http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        http_session.mount('http://', adapter)
+        http_session.mount('https://', adapter)
+        thread_local.session = http_session
+    return http_session
+
+@contextmanager
+def db_connection(database='migration'):
+    """Borrow a connection from the small pool kept for the migration or Piwigo database."""
+    with db_pools_lock:
+        if database not in db_pools:
+            if database == 'migration':
+                db_pools[database] = create_pool(database, max(DB_POOL_SIZE, MIGRATION_DB_CONNECTIONS),
+                                                 url=DATABASE_URL, config=DB_CONFIG)
+            else:
+                db_pools[database] = create_pool(database, DB_POOL_SIZE, config=PW_DB_CONFIG)
+        pool = db_pools[database]
+    conn = pool.get_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()  # Returns the connection to the pool
 
 def piwigo_create_album(name, parent_id, title, description):
     data = {
-        'method': 'pwg.categories.add',
         'name': title,
         'parent': parent_id,
         'comment': description,
     }
-    response = session.post(PIWIGO_API_URL, data=data)
-    logger.debug(f"Create album response status code: {response.status_code}")
-    logger.debug(f"Create album response text: {response.text}")
-    result = ElementTree.fromstring(response.content)
-    if result.get('stat') == 'ok':
-        album_id = result.find('id').text
-        logger.debug(f"Created album {title} with ID {album_id}")
-        return album_id
-    else:
-        raise Exception(f"Failed to create album {title}")
+    result = piwigo.call('pwg.categories.add', data)
+    album_id = result.find('id').text
+    metrics.count('albums_created')
+    logger.debug("Created album %s with ID %s", title, album_id)
+    return album_id
+
+def parse_content_range(value):
+    # 'bytes 100-199/1000' -> (100, 1000); 'bytes */1000' -> (None, 1000)
+    match = re.match(r'bytes (?:(\d+)-\d+|\*)/(\d+|\*)', value or '')
+    if not match:
+        return None, None
+    start = int(match.group(1)) if match.group(1) is not None else None
+    total = int(match.group(2)) if match.group(2) != '*' else None
+    return start, total
 
 def download_image(url, filepath):
-    logger.debug(f"Downloading image from URL: {url} to filepath: {filepath}")
-    response = requests.get(url)
-    response.raise_for_status()
-    with open(filepath, 'wb') as f:
-        f.write(response.content)
-    logger.debug(f"Downloaded image to {filepath}")
+    """Stream an image to disk, resuming a previous partial download if there is one.
+
+    Data is written to ``filepath + '.part'`` and only renamed to ``filepath`` once the
+    size matches what the server announced, so a file at ``filepath`` is always complete.
+    """
+    if is_local(url):
+        copy_local_image(url, filepath)
+        return
+    # A retried download resumes from what the failed attempt already wrote
+    gallery_scheduler.call(stream_image, url, filepath)
+
+def stream_image(url, filepath):
+    logger.debug("Downloading image from URL: %s to filepath: %s", url, filepath)
+    part_path = filepath + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    with get_http_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if offset and response.status_code == 416:
+            # Nothing left to fetch if the partial file already has every byte
+            _, expected_size = parse_content_range(response.headers.get('Content-Range'))
+            if expected_size != offset:
+                os.remove(part_path)
+                raise IOError(f"Server rejected resume of {url} at byte {offset}")
+        else:
+            response.raise_for_status()
+            if response.status_code == 206:
+                start, expected_size = parse_content_range(response.headers.get('Content-Range'))
+                if start != offset:
+                    os.remove(part_path)
+                    raise IOError(f"Server resumed {url} at byte {start} instead of {offset}")
+                mode = 'ab'
+                logger.debug("Resuming download of %s at byte %s", url, offset)
+            else:
+                # Full response, either a fresh download or the server ignored the Range header
+                mode = 'wb'
+                encoded = response.headers.get('Content-Encoding', 'identity') != 'identity'
+                length = response.headers.get('Content-Length')
+                expected_size = int(length) if length and not encoded else None
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        raise IOError(f"Incomplete download of {url}: {size} of {expected_size} bytes")
+    os.replace(part_path, filepath)
+    logger.debug("Downloaded image to %s (%s bytes)", filepath, size)
 
 def update_album_info(album_id, title, caption, description):
     data = {
-        'method': 'pwg.categories.setInfo',
         'category_id': album_id,
         'name': title,
         'comment': f"{caption} - {description}" if caption else description
     }
-    response = session.post(PIWIGO_API_URL, data=data)
-    logger.debug(f"Update album info response status code: {response.status_code}")
-    logger.debug(f"Update album info response text: {response.text}")
-    result = ElementTree.fromstring(response.content)
-    if result.get('stat') != 'ok':
-        raise Exception(f"Failed to update album info for album ID {album_id}")
-
-def process_album(album_name):
-    conn = mysql.connector.connect(**DB_CONFIG)
-    cursor = conn.cursor(dictionary=True)
-    pw_conn = mysql.connector.connect(**PW_DB_CONFIG)
-    pw_cursor = pw_conn.cursor(dictionary=True)
-
-    # Fetch album info from database
-    cursor.execute("SELECT * FROM albums WHERE name=%s", (album_name,))
-    album = cursor.fetchone()
-    logger.debug(f"Album fetched: {album}")
-    if not album:
-        logger.error(f"Album {album_name} not found in database")
-        return
+    piwigo.call('pwg.categories.setInfo', data)
 
-    album_id = album['id']
-    album_title = album['title']
-    album_caption = album['caption']
-    album_description = album['description']
+def load_album_id_map(cursor):
+    """Map migration album ids to the Piwigo category ids recorded when they were created."""
+    cursor.execute("SELECT id, piwigo_id FROM albums WHERE piwigo_id IS NOT NULL")
+    return {row['id']: row['piwigo_id'] for row in cursor.fetchall()}
 
-    # Check if the album is already created
-    if album['created']:
-        logger.info(f"Album {album_name} already created, skipping album creation")
-        pw_cursor.execute("SELECT id FROM piwigo_categories WHERE name=%s", (album_title,))
+def find_piwigo_album_by_title(title):
+    # Only for albums created before piwigo_id was recorded
+    with db_connection('piwigo') as pw_conn:
+        pw_cursor = pw_conn.cursor(dictionary=True)
+        pw_cursor.execute(f"SELECT id FROM {PW_DB_PREFIX}categories WHERE name=%s", (title,))
         result = pw_cursor.fetchone()
-        if result:
-            logger.debug(f"Found album {album_title} in Piwigo database with ID {result['id']}")
-            piwigo_album_id = result['id']
+        pw_cursor.close()
+    return result['id'] if result else None
+
+def process_album(album_name, options):
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        # Fetch album info from database
+        cursor.execute("SELECT * FROM albums WHERE name=%s", (album_name,))
+        album = cursor.fetchone()
+        logger.debug("Album fetched: %s", album)
+        if not album:
+            logger.error(f"Album {album_name} not found in database")
         else:
-            logger.error(f"Could not find album {album_title} in Piwigo database")
-            return
-        # Process sub-albums
-        cursor.execute("SELECT * FROM albums WHERE parent_id=%s", (album_id,))
-        subalbums = cursor.fetchall()
-        logger.debug(f"Subalbums fetched: {subalbums}")
-        for subalbum in subalbums:
-            subalbum_id = subalbum['id']
-            subalbum_name = subalbum['name']
-            subalbum_title = subalbum['title']
-            subalbum_caption = subalbum['caption']
-            subalbum_description = subalbum['description']
-
-            if subalbum['created']:
-                logger.info(f"Album {subalbum_name} already created, skipping album creation")
-                pw_cursor.execute("SELECT id FROM piwigo_categories WHERE name=%s", (subalbum_title,))
-                result = pw_cursor.fetchone()
-                if result:
-                    logger.debug(f"Found album {subalbum_title} in Piwigo database with ID {result['id']}")
-                    piwigo_subalbum_id = result['id']
-                else:
-                    logger.error(f"Could not find sub album {subalbum_title} in Piwigo database")
-                    return
-            else:
-                # Process sub-albums
-                piwigo_login()
-                piwigo_subalbum_id = piwigo_create_album(subalbum_name, piwigo_album_id, subalbum_title, subalbum_description)
-                cursor.execute("UPDATE albums SET created=TRUE WHERE id=%s", (subalbum_id,))
-                conn.commit()
-            process_photos(subalbum_id, subalbum_name, piwigo_subalbum_id)
+            metrics.expect('photos', count_pending_photos(cursor, album_tree_ids(cursor, [album_name])))
+            album_ids = load_album_id_map(cursor)
+            migrate_album(album, None, options, conn, cursor, album_ids)
+        cursor.close()
+
+def ensure_piwigo_album(album, piwigo_parent_id, conn, cursor, album_ids):
+    """Return the Piwigo id of the album, creating it first if needed, or None."""
+    album_name = album['name']
+    piwigo_album_id = album_ids.get(album['id'])
+    if piwigo_album_id is None and album['created']:
+        piwigo_album_id = find_piwigo_album_by_title(album['title'])
+        if piwigo_album_id is None:
+            logger.error(f"Could not find album {album['title']} in Piwigo database")
+            return None
+        logger.debug("Found album %s in Piwigo database with ID %s", album['title'], piwigo_album_id)
+        cursor.execute("UPDATE albums SET piwigo_id=%s WHERE id=%s", (piwigo_album_id, album['id']))
+        conn.commit()
+        album_ids[album['id']] = piwigo_album_id
+
+    if piwigo_album_id is None:
+        logger.debug("Creating album %s in Piwigo", album['title'])
+        piwigo_album_id = piwigo_create_album(album_name, piwigo_parent_id, album['title'], album['description'])
+        cursor.execute("UPDATE albums SET created=TRUE, piwigo_id=%s WHERE id=%s", (piwigo_album_id, album['id']))
+        conn.commit()
+        album_ids[album['id']] = piwigo_album_id
     else:
-        # Login to Piwigo
-        piwigo_login()
+        logger.info(f"Album {album_name} already created, skipping album creation")
+    return piwigo_album_id
+
+def mark_album_migrated(album_id, conn, cursor):
+    cursor.execute("UPDATE albums SET migrated=TRUE WHERE id=%s", (album_id,))
+    conn.commit()
 
-        # Create album in Piwigo
-        logger.debug(f"Creating album {album_title} in Piwigo")
-        piwigo_album_id = piwigo_create_album(album_name, None, album_title, album_description)
+def migrate_album(album, piwigo_parent_id, options, conn, cursor, album_ids):
+    """Create the album in Piwigo unless done before, then migrate its sub-albums and photos.
 
-        # Update album info in database
-        cursor.execute("UPDATE albums SET created=TRUE WHERE id=%s", (album_id,))
+    Sub-albums are handled recursively, so trees of any depth are migrated. Piwigo ids
+    come from album_ids, filled from the migration database at startup and whenever an
+    album is created, so resuming needs no lookups in the Piwigo database.
+    """
+    album_name = album['name']
+    piwigo_album_id = ensure_piwigo_album(album, piwigo_parent_id, conn, cursor, album_ids)
+    if piwigo_album_id is None:
+        return
+
+    # Process sub-albums
+    cursor.execute("SELECT * FROM albums WHERE parent_id=%s", (album['id'],))
+    subalbums = cursor.fetchall()
+    logger.debug("Subalbums fetched: %s", subalbums)
+    for subalbum in subalbums:
+        migrate_album(subalbum, piwigo_album_id, options, conn, cursor, album_ids)
+
+    # Process photos in the album itself
+    if process_photos(album['id'], album_name, piwigo_album_id, options, conn, cursor) == 0:
+        mark_album_migrated(album['id'], conn, cursor)
+
+def album_tree_ids(cursor, album_names):
+    """Ids of the named albums and of all albums below them."""
+    placeholders = ', '.join(['%s'] * len(album_names))
+    cursor.execute(f"SELECT id FROM albums WHERE name IN ({placeholders})", tuple(album_names))
+    ids = {row['id'] for row in cursor.fetchall()}
+    cursor.execute("SELECT id, parent_id FROM albums WHERE parent_id IS NOT NULL")
+    children = {}
+    for row in cursor.fetchall():
+        children.setdefault(row['parent_id'], []).append(row['id'])
+    pending = list(ids)
+    while pending:
+        for child_id in children.get(pending.pop(), []):
+            if child_id not in ids:
+                ids.add(child_id)
+                pending.append(child_id)
+    return ids
+
+def count_pending_photos(cursor, album_ids):
+    cursor.execute("SELECT album_id, COUNT(*) AS pending FROM photos WHERE uploaded = FALSE GROUP BY album_id")
+    return sum(row['pending'] for row in cursor.fetchall() if row['album_id'] in album_ids)
+
+def lease_expiry():
+    # Leases are compared with the clock of whichever worker reads them, so keep node clocks in sync
+    return datetime.utcnow() + timedelta(seconds=MIGRATION_LEASE_SECONDS)
+
+def claim_album(conn, cursor, worker, scope, skip):
+    """Claim an unmigrated album whose parent already exists in Piwigo, or return None.
+
+    The claim is a conditional UPDATE that only succeeds while nobody else holds a live
+    lease on the album, so of several workers racing for it exactly one gets rowcount 1.
+    """
+    now = datetime.utcnow()
+    cursor.execute(
+        "SELECT a.id FROM albums a LEFT JOIN albums p ON p.id = a.parent_id "
+        "WHERE a.migrated = FALSE AND (a.claimed_by IS NULL OR a.lease_expires < %s) "
+        "AND (a.parent_id IS NULL OR p.piwigo_id IS NOT NULL) ORDER BY a.id", (now,))
+    candidates = [row['id'] for row in cursor.fetchall()
+                  if row['id'] not in skip and (scope is None or row['id'] in scope)]
+    for album_id in candidates:
+        cursor.execute(
+            "UPDATE albums SET claimed_by=%s, lease_expires=%s "
+            "WHERE id=%s AND migrated = FALSE AND (claimed_by IS NULL OR lease_expires < %s)",
+            (worker, lease_expiry(), album_id, now))
+        claimed = cursor.rowcount == 1
         conn.commit()
+        if claimed:
+            # Read the row again, another worker may have created the album in the meantime
+            cursor.execute("SELECT * FROM albums WHERE id=%s", (album_id,))
+            return cursor.fetchone()
+    return None
 
-        # Process sub-albums
-        cursor.execute("SELECT * FROM albums WHERE parent_id=%s", (album_id,))
-        subalbums = cursor.fetchall()
-        logger.debug(f"Subalbums fetched: {subalbums}")
-        for subalbum in subalbums:
-            subalbum_id = subalbum['id']
-            subalbum_name = subalbum['name']
-            subalbum_title = subalbum['title']
-            subalbum_caption = subalbum['caption']
-            subalbum_description = subalbum['description']
-
-            piwigo_subalbum_id = piwigo_create_album(subalbum_name, piwigo_album_id, subalbum_title, subalbum_description)
-
-            cursor.execute("UPDATE albums SET created=TRUE WHERE id=%s", (subalbum_id,))
-            conn.commit()
-
-            process_photos(subalbum_id, subalbum_name, piwigo_subalbum_id)
-
-        # Process photos in the main album
-        process_photos(album_id, album_name, piwigo_album_id)
-
-    cursor.close()
-    conn.close()
-    pw_cursor.close()
-    pw_conn.close()
-
-def process_photos(album_id, album_name, piwigo_album_id):
-    logger.debug(f"Processing photos for album ID {album_id}, album name {album_name}, Piwigo album ID {piwigo_album_id}")
-    conn = mysql.connector.connect(**DB_CONFIG)
-    cursor = conn.cursor(dictionary=True)
-
-    cursor.execute("SELECT * FROM photos WHERE album_id=%s", (album_id,))
-    photos = cursor.fetchall()
-    logger.debug(f"Photos fetched: {photos}")
-    # Login to Piwigo
-    piwigo_login()
-    for photo in photos:
-        photo_path = None
-        if not photo['downloaded']:
-            photo_url = f"{GALLERY_BASE_URL}/{album_name}/{photo['filename']}"
-            photo_path = os.path.join(DOWNLOAD_DIR, album_name, photo['filename'])
-            os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+def albums_claimed_by_others(cursor, worker, scope):
+    cursor.execute(
+        "SELECT id FROM albums WHERE migrated = FALSE AND claimed_by IS NOT NULL "
+        "AND claimed_by <> %s AND lease_expires >= %s", (worker, datetime.utcnow()))
+    return any(scope is None or row['id'] in scope for row in cursor.fetchall())
+
+def release_album(album_id, worker, migrated, conn, cursor):
+    cursor.execute("UPDATE albums SET claimed_by=NULL, lease_expires=NULL, migrated=%s WHERE id=%s AND claimed_by=%s",
+                   (migrated, album_id, worker))
+    conn.commit()
+
+class AlbumLease:
+    """Renews a worker's claim on an album in the background while it is being migrated.
+
+    ``lost`` is set once another worker has taken the album over, or once renewals have
+    failed for so long that the lease may have run out; the album must then be left alone.
+    """
+
+    def __init__(self, album_id, worker):
+        self.album_id = album_id
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def renew(self):
+        renewed_at = time.monotonic()
+        while not self.stopped.wait(MIGRATION_LEASE_SECONDS / 3):
             try:
-                download_image(photo_url, photo_path)
-                cursor.execute("UPDATE photos SET downloaded=TRUE WHERE id=%s", (photo['id'],))
-                conn.commit()
+                with db_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("UPDATE albums SET lease_expires=%s WHERE id=%s AND claimed_by=%s",
+                                   (lease_expiry(), self.album_id, self.worker))
+                    renewed = cursor.rowcount == 1
+                    conn.commit()
+                    cursor.close()
             except Exception as e:
-                logger.error(f"Error downloading photo {photo['filename']}: {e}")
+                logger.warning(f"Could not renew the claim on album {self.album_id}: {e}")
+                if time.monotonic() - renewed_at >= MIGRATION_LEASE_SECONDS:
+                    logger.error(f"The claim on album {self.album_id} may have expired, giving the album up")
+                    self.lost.set()
+                    return
                 continue
-        else:
-            photo_path = os.path.join(DOWNLOAD_DIR, album_name, photo['filename'])
+            if not renewed:
+                logger.error(f"The claim on album {self.album_id} expired and was taken over by another worker")
+                self.lost.set()
+                return
+            renewed_at = time.monotonic()
+
+def run_claim_worker(album_names, options):
+    """Migrate albums claimed one at a time from the migration database until none are left.
+
+    Any number of these workers, in one or several processes on one or several machines,
+    can share a migration database. An album becomes claimable once its parent exists in
+    Piwigo, and a worker stops when nothing is claimable and no other worker holds a live
+    claim that could make more albums claimable.
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    reporter = ProgressReporter('photos', 'bytes_downloaded',
+                                path=process_metrics_file() if options.processes > 1 else METRICS_FILE)
+    try:
+        claim_albums(worker, album_names, options, reporter)
+    finally:
+        shutdown_optimize_pool()
+    logger.info(f"Worker {worker} found no more albums to migrate")
+
+def claim_albums(worker, album_names, options, reporter):
+    given_up = set()  # Albums this worker failed to migrate; others may still try them
+    with reporter, db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        scope = album_tree_ids(cursor, album_names) if album_names else None
+        while True:
+            album = claim_album(conn, cursor, worker, scope, given_up)
+            if album is None:
+                if not albums_claimed_by_others(cursor, worker, scope):
+                    break
+                time.sleep(CLAIM_POLL_SECONDS)
+                continue
+            logger.info(f"Worker {worker} claimed album {album['name']}")
+            migrated = False
+            lease = AlbumLease(album['id'], worker)
+            try:
+                with lease:
+                    album_ids = load_album_id_map(cursor)
+                    piwigo_album_id = ensure_piwigo_album(album, album_ids.get(album['parent_id']), conn, cursor, album_ids)
+                    if piwigo_album_id is not None:
+                        migrated = process_photos(album['id'], album['name'], piwigo_album_id, options, conn, cursor,
+                                                  lost=lease.lost) == 0
+            except Exception as e:
+                logger.error(f"Error migrating album {album['name']}: {e}")
+            if lease.lost.is_set():
+                # The album may belong to another worker now: neither mark it nor release it
+                given_up.add(album['id'])
+                continue
+            release_album(album['id'], worker, migrated, conn, cursor)
+            if not migrated:
+                given_up.add(album['id'])
+        cursor.close()
+
+def file_md5(filepath):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
 
-        logger.debug(f"Photo: {photo['caption']} uploaded status: {photo['uploaded']}")
-        if not photo['uploaded']:
-            logger.debug(f"Photo: {photo['caption']} not uploaded, uploading")
-            logger.debug(f"Photo path: {photo_path}")
+def piwigo_add_chunk(original_sum, position, chunk):
+    data = {
+        'original_sum': original_sum,
+        'type': 'file',
+        'position': position,
+        'data': base64.b64encode(chunk).decode('ascii'),
+    }
+    # Only this chunk is sent again on failure, the ones already on the server are kept
+    for attempt in range(1, PIWIGO_CHUNK_RETRIES + 1):
+        try:
+            piwigo.call('pwg.images.addChunk', data)
+            return
+        except (requests.RequestException, PiwigoError) as e:
+            error = e
+        logger.warning(f"Chunk {position} of {original_sum} failed on attempt {attempt}: {error}")
+    raise Exception(f"Failed to upload chunk {position} of {original_sum}")
+
+def upload_photo_chunked(photo, photo_path, data, original_sum=None):
+    """Upload a large file with pwg.images.addChunk and register it with pwg.images.add.
+
+    Chunks are sent in parallel when PIWIGO_CHUNK_WORKERS is above one; Piwigo
+    reassembles them by position. pwg.images.add has no date_available parameter,
+    so Piwigo sets the upload date itself for photos taking this path.
+    """
+    original_sum = original_sum or file_md5(photo_path)
+    chunk_count = max(1, math.ceil(os.path.getsize(photo_path) / PIWIGO_CHUNK_SIZE))
+    logger.debug("Uploading %s in %s chunks of %s bytes", photo['filename'], chunk_count, PIWIGO_CHUNK_SIZE)
+
+    def send_chunk(position):
+        with open(photo_path, 'rb') as f:
+            f.seek(position * PIWIGO_CHUNK_SIZE)
+            chunk = f.read(PIWIGO_CHUNK_SIZE)
+        piwigo_add_chunk(original_sum, position, chunk)
+
+    with ThreadPoolExecutor(max_workers=max(1, PIWIGO_CHUNK_WORKERS)) as executor:
+        list(executor.map(send_chunk, range(chunk_count)))
+
+    add_data = {
+        'original_sum': original_sum,
+        'original_filename': photo['filename'],
+        'categories': data['category'],
+        'name': data['name'],
+        'comment': data['comment'],
+        'date_creation': data['date_creation'],
+    }
+    piwigo.call('pwg.images.add', add_data)
+
+def photo_upload_data(photo, piwigo_album_id):
+    if photo['description'] and photo['caption']:
+        photo['description'] = photo['caption'] + ' - ' + photo['description']
+    elif photo['caption']:
+        photo['description'] = photo['caption']
+    if len(photo['caption']) > 255:
+        photo['caption'] = photo['caption'][:255]
+    data = {
+        'category': piwigo_album_id,
+        'name': photo['caption'],
+        'comment': photo['description'],
+        'date_creation': photo['capturedate'].strftime('%Y-%m-%d %H:%M:%S'),  # convert to string
+        'date_available': photo['uploaddate'].strftime('%Y-%m-%d %H:%M:%S')  # convert to string
+    }
+    return data
+
+def upload_photo(photo, photo_path, piwigo_album_id, md5sum=None):
+    data = photo_upload_data(photo, piwigo_album_id)
+    logger.debug("Uploading photo: %s to album ID: %s", photo['filename'], piwigo_album_id)
+    logger.debug("Upload data: %s", data)
+    try:
+        if os.path.getsize(photo_path) >= PIWIGO_CHUNKED_UPLOAD_THRESHOLD:
+            upload_photo_chunked(photo, photo_path, data, md5sum)
         else:
-            logger.debug(f"Photo: {photo['caption']} already uploaded, \
-                         skipping")
-        if not photo['uploaded'] and photo_path:
-            if os.path.exists(photo_path):
-                with open(photo_path, 'rb') as f:
-                    mime_type = 'image/jpeg' if photo_path.endswith('.jpeg') or photo_path.endswith('.jpg') else 'image/png'
-                    files = {'image': (photo['filename'], f, mime_type)}
-                    if photo['description'] and photo['caption']:
-                        photo['description'] = photo['caption'] + ' - ' + photo['description']
-                    elif photo['caption']:
-                        photo['description'] = photo['caption']
-                    if len(photo['caption']) > 255:
-                        photo['caption'] = photo['caption'][:255]
-                    data = {
-                        'method': 'pwg.images.addSimple',
-                        'category': piwigo_album_id,
-                        'name': photo['caption'],
-                        'comment': photo['description'],
-					    'date_creation': photo['capturedate'].strftime('%Y-%m-%d %H:%M:%S'),  # convert to string
-					    'date_available': photo['uploaddate'].strftime('%Y-%m-%d %H:%M:%S')  # convert to string
-                    }
-                    logger.debug(f"Uploading photo: {photo['filename']} to album ID: {piwigo_album_id}")
-                    logger.debug(f"Upload data: {data}")
-                    response = session.post(PIWIGO_API_URL, data=data, files=files)
-                    logger.debug(f"Upload photo response status code: {response.status_code}")
-                    logger.debug(f"Upload photo response text: {response.text}")
-                    if response.status_code == 200:
-                        result = ElementTree.fromstring(response.content)
-                        if result.get('stat') == 'ok':
-                            cursor.execute("UPDATE photos SET uploaded=TRUE WHERE id=%s", (photo['id'],))
-                            conn.commit()
-                        else:
-                            logger.error(f"Failed to upload photo {photo['filename']}")
-                    else:
-                        logger.error(f"Failed to upload photo {photo['filename']} with status code: {response.status_code}")
+            with open(photo_path, 'rb') as f:
+                files = {'image': (photo['filename'], f, sniff_mime_type(photo_path))}
+                piwigo.call('pwg.images.addSimple', data, files)
+    except PiwigoError as e:
+        logger.error(f"Failed to upload photo {photo['filename']}: {e}")
+        return False
+    return True
+
+def find_existing_images(md5sums):
+    """Ask Piwigo which of the md5sums it already has, as {md5sum: image_id}."""
+    result = piwigo.call('pwg.images.exist', {'md5sum_list': ','.join(md5sums)}, response_format='json')
+    # An empty PHP array comes back as a JSON list
+    return {md5sum: image_id for md5sum, image_id in (result or {}).items() if image_id} \
+        if isinstance(result, dict) else {}
+
+def link_image_to_album(image_id, piwigo_album_id):
+    data = {
+        'image_id': image_id,
+        'categories': piwigo_album_id,
+        'multiple_value_mode': 'append',
+    }
+    piwigo.call('pwg.images.setInfo', data)
+
+class DiskBudget:
+    """Bytes of downloaded photos still on disk, kept under limit (0 means no limit).
+
+    Downloads wait for room while uploads that will free space are in flight. The limit
+    is soft: once nothing is in flight, e.g. because the remaining files failed to upload,
+    downloads go ahead rather than wait forever, and each download worker may overshoot
+    it by one file.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def wait_for_room(self):
+        with self.condition:
+            while self.limit and self.used >= self.limit and self.in_flight:
+                self.condition.wait()
+
+    def add(self, size):
+        with self.condition:
+            self.used += size
+            self.in_flight += 1
+
+    def resize(self, old_size, new_size):
+        # A file on disk was replaced by a smaller one
+        with self.condition:
+            self.used += new_size - old_size
+            self.condition.notify_all()
+
+    def finish(self, freed=0):
+        with self.condition:
+            self.used -= freed
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def lift(self):
+        # Stops waiting for uploads that will not come, once the album is given up
+        with self.condition:
+            self.limit = 0
+            self.condition.notify_all()
+
+def download_photo(photo, album_name):
+    """Make sure the photo is in the download directory and return its path, or None."""
+    photo_path = os.path.join(DOWNLOAD_DIR, album_name, photo['filename'])
+    # A photo flagged as downloaded may have been deleted after an upload that was never recorded
+    if photo['downloaded'] and os.path.exists(photo_path):
+        return photo_path
+    photo_url = f"{GALLERY_BASE_URL}/{album_name}/{photo['filename']}"
+    try:
+        os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+        with metrics.stage('download'):
+            download_image(photo_url, photo_path)
+        metrics.count('bytes_downloaded', os.path.getsize(photo_path))
+    except Exception as e:
+        logger.error(f"Error downloading photo {photo['filename']}: {e}")
+        return None
+    return photo_path
+
+def process_photos(album_id, album_name, piwigo_album_id, options, conn, cursor, lost=None):
+    """Download and upload the photos of an album in two overlapping stages, returning the number that failed.
+
+    The photos still to upload are streamed from the database into a bounded queue read
+    by download workers, which feed a bounded queue read by upload workers, so downloads
+    pause when uploads fall behind and, with options.delete_uploaded, when the files
+    waiting on disk reach options.disk_budget. Workers only talk to Gallery and Piwigo;
+    the downloaded/uploaded flags are written from this thread as events arrive, on the
+    caller's connection, and a file is deleted only after its uploaded flag is committed,
+    so an interrupted run resumes where it left off. Once the lost event is set, the
+    workers are stopped and the album counts as failed.
+    """
+    logger.debug("Processing photos for album ID %s, album name %s, Piwigo album ID %s", album_id, album_name, piwigo_album_id)
+    return process_photo_pipeline(album_id, album_name, piwigo_album_id, options, conn, cursor, lost)
+
+def iter_pending_photos(album_id, page_size=PHOTO_PAGE_SIZE):
+    """Yield the photos of an album that are not uploaded yet, in id order.
+
+    Photos are read page by page with keyset queries (id above the last one seen) on a
+    connection of their own, selecting PHOTO_COLUMNS only. A page is read off the
+    unbuffered cursor before its photos are handed out, so no result set stays open
+    while the pipeline is busy.
+    """
+    last_id = 0
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        while True:
+            with metrics.stage('db_query'):
+                cursor.execute(f"SELECT {PHOTO_COLUMNS} FROM photos "
+                               "WHERE album_id=%s AND uploaded = FALSE AND id > %s ORDER BY id LIMIT %s",
+                               (album_id, last_id, page_size))
+                page = list(cursor)
+            yield from page
+            if len(page) < page_size:
+                break
+            last_id = page[-1]['id']
+        cursor.close()
+
+def process_photo_pipeline(album_id, album_name, piwigo_album_id, options, conn, cursor, lost=None):
+    workers = max(1, options.workers)
+    budget = DiskBudget(options.disk_budget * 1024 * 1024 if options.delete_uploaded else 0)
+    download_queue = queue.Queue(maxsize=workers * 2)
+    stopping = threading.Event()
+    dedup_queue = queue.Queue(maxsize=max(DEDUP_BATCH_SIZE, workers * 2))
+    optimizers = max(1, OPTIMIZE_PROCESSES) if options.optimize else 0
+    optimize_queue = queue.Queue(maxsize=optimizers * 2)
+    upload_queue = queue.Queue(maxsize=workers * 2)
+    events = queue.Queue()
+
+    def list_photos():
+        listed = 0
+        filenames = set()
+        try:
+            for photo in iter_pending_photos(album_id):
+                if photo['filename'] in filenames:
+                    # A row collected twice for the same file: it shares the fate of the first
+                    # one rather than being downloaded into the same path and uploaded again
+                    events.put(('duplicate', photo, None, 0))
+                    listed += 1
+                    continue
+                filenames.add(photo['filename'])
+                while not stopping.is_set():
+                    try:
+                        download_queue.put(photo, timeout=BATCH_WAIT)
+                        break
+                    except queue.Full:
+                        pass
+                if stopping.is_set():
+                    break
+                listed += 1
+        except Exception as e:
+            logger.error(f"Error listing photos of album {album_name}: {e}")
+            events.put(('listing_failed', None, None, 0))
+        finally:
+            for _ in range(workers):
+                download_queue.put(None)
+            events.put(('listed', None, None, listed))
+
+    def hand_on(next_queue, item):
+        # Blocks while the next stage is behind, unless the album is given up
+        while not stopping.is_set():
+            try:
+                next_queue.put(item, timeout=BATCH_WAIT)
+                return
+            except queue.Full:
+                pass
+
+    def download_worker():
+        while True:
+            photo = download_queue.get()
+            if photo is None:
+                return
+            if stopping.is_set():
+                continue  # Drain the queue so that the listing can finish
+            try:
+                download_one(photo)
+            except Exception as e:
+                # Every photo has to end in an event, or the album never finishes
+                logger.error(f"Error downloading photo {photo['filename']}: {e}")
+                events.put(('failed', photo, None, 0))
+
+    def download_one(photo):
+        next_queue = optimize_queue if options.optimize else dedup_queue if options.dedup else upload_queue
+        budget.wait_for_room()
+        photo_path = download_photo(photo, album_name)
+        try:
+            size = os.path.getsize(photo_path) if photo_path else None
+        except OSError as e:
+            logger.error(f"Downloaded photo {photo['filename']} disappeared: {e}")
+            size = None
+        if size is None:
+            events.put(('failed', photo, None, 0))
+            return
+        if not photo['downloaded']:
+            events.put(('downloaded', photo, photo_path, 0))
+        budget.add(size)
+        hand_on(next_queue, (photo, photo_path, size, None))
+
+    def optimize_worker(pool):
+        # Each of these threads keeps one process of the pool busy
+        next_queue = dedup_queue if options.dedup else upload_queue
+        while True:
+            item = optimize_queue.get()
+            if item is None:
+                return
+            photo, photo_path, size, _ = item
+            target = os.path.join(OPTIMIZED_DIR, album_name, photo['filename'])
+            try:
+                with metrics.stage('optimize'):
+                    optimized = pool.submit(optimize_image, photo_path, target, options.max_dimension,
+                                            OPTIMIZE_JPEG_QUALITY, OPTIMIZE_STRIP_METADATA).result()
+                optimized_size = os.path.getsize(target) if optimized else size
+            except Exception as e:
+                logger.warning(f"Could not optimize photo {photo['filename']}, uploading it as it is: {e}")
+                optimized = False
+            if optimized:
+                metrics.count('bytes_saved', size - optimized_size)
+                if options.delete_uploaded:
+                    # Only this link to the data goes; a new run downloads the photo again if needed
+                    try:
+                        os.remove(photo_path)
+                    except OSError as e:
+                        logger.warning(f"Could not delete downloaded photo {photo_path}: {e}")
+                budget.resize(size, optimized_size)
+                photo_path, size = target, optimized_size
+            hand_on(next_queue, (photo, photo_path, size, None))
+
+    def hash_photo(item):
+        try:
+            return file_md5(item[1])
+        except Exception as e:
+            logger.error(f"Cannot hash photo {item[0]['filename']}: {e}")
+            return None
+
+    def dedup_batch(batch, hash_pool):
+        with metrics.stage('hash'):
+            md5sums = list(hash_pool.map(hash_photo, batch))
+        try:
+            with metrics.stage('dedup'):
+                existing = find_existing_images({md5sum for md5sum in md5sums if md5sum})
+        except Exception as e:
+            logger.warning(f"Duplicate check failed, uploading {len(batch)} photos: {e}")
+            existing = {}
+        for (photo, photo_path, size, _), md5sum in zip(batch, md5sums):
+            image_id = existing.get(md5sum)
+            if image_id is None:
+                hand_on(upload_queue, (photo, photo_path, size, md5sum))
+                continue
+            try:
+                link_image_to_album(image_id, piwigo_album_id)
+            except Exception as e:
+                logger.error(f"Error linking photo {photo['filename']} to image {image_id}: {e}")
+                budget.finish()
+                events.put(('failed', photo, photo_path, 0))
+                continue
+            metrics.count('photos_linked')
+            logger.info(f"Photo {photo['filename']} already in Piwigo as image {image_id}, linked it to album {piwigo_album_id}")
+            photo['md5sum'] = md5sum
+            events.put(('uploaded', photo, photo_path, size))
+
+    def dedup_worker():
+        # Hashes downloaded photos in batches and only passes on those Piwigo does not have yet
+        with ThreadPoolExecutor(max_workers=workers) as hash_pool:
+            finished = False
+            while not finished:
+                batch, finished = next_batch(dedup_queue, DEDUP_BATCH_SIZE)
+                if batch:
+                    dedup_batch(batch, hash_pool)
+
+    def upload_worker():
+        while True:
+            item = upload_queue.get()
+            if item is None:
+                return
+            photo, photo_path, size, md5sum = item
+            logger.debug("Photo: %s not uploaded, uploading from %s", photo['caption'], photo_path)
+            try:
+                if md5sum is None:
+                    # Recorded with the uploaded flag, so that --verify knows what Piwigo got
+                    with metrics.stage('hash'):
+                        md5sum = file_md5(photo_path)
+                with metrics.stage('upload'):
+                    uploaded = upload_photo(photo, photo_path, piwigo_album_id, md5sum)
+            except Exception as e:
+                logger.error(f"Error uploading photo {photo['filename']}: {e}")
+                uploaded = False
+            if uploaded:
+                metrics.count('bytes_uploaded', size)
+                photo['md5sum'] = md5sum
+                events.put(('uploaded', photo, photo_path, size))
             else:
-                logger.error(f"Photo path does not exist: {photo_path}")
+                budget.finish()
+                events.put(('failed', photo, photo_path, 0))
 
-    cursor.close()
-    conn.close()
+    def direct_import_batch(batch):
+        try:
+            imports = []
+            for photo, photo_path, size, md5sum in batch:
+                data = photo_upload_data(photo, piwigo_album_id)
+                imports.append({
+                    'path': photo_path,
+                    'filename': photo['filename'],
+                    'name': data['name'],
+                    'comment': data['comment'],
+                    'date_creation': data['date_creation'],
+                    'date_available': data['date_available'],
+                    'md5sum': md5sum or file_md5(photo_path),
+                })
+            with metrics.stage('import'), db_connection('piwigo') as pw_conn:
+                importer = DirectImporter(pw_conn, PIWIGO_ROOT_DIR, PW_DB_PREFIX, PIWIGO_ADDED_BY)
+                importer.import_photos(piwigo_album_id, imports)
+        except Exception as e:
+            logger.error(f"Error importing {len(batch)} photos into Piwigo album {piwigo_album_id}: {e}")
+            for photo, photo_path, size, md5sum in batch:
+                budget.finish()
+                events.put(('failed', photo, photo_path, 0))
+            return
+        for (photo, photo_path, size, _), imported in zip(batch, imports):
+            metrics.count('bytes_uploaded', size)
+            photo['md5sum'] = imported['md5sum']
+            events.put(('uploaded', photo, photo_path, size))
+
+    def direct_import_worker():
+        # Registers photos with the Piwigo database in batches instead of uploading them
+        finished = False
+        while not finished:
+            batch, finished = next_batch(upload_queue, DIRECT_BATCH_SIZE)
+            if batch:
+                direct_import_batch(batch)
+
+    with ThreadPoolExecutor(max_workers=workers * 2 + optimizers + 2) as executor:
+        futures = [executor.submit(list_photos)]
+        for _ in range(optimizers):
+            futures.append(executor.submit(optimize_worker, get_optimize_pool()))
+        for _ in range(workers):
+            futures.append(executor.submit(download_worker))
+            if options.backend == 'ws':
+                futures.append(executor.submit(upload_worker))
+        if options.backend == 'direct':
+            futures.append(executor.submit(direct_import_worker))
+        if options.dedup:
+            futures.append(executor.submit(dedup_worker))
+        try:
+            return record_photo_events(events, cursor, conn, budget, options, futures, lost)
+        finally:
+            stopping.set()
+            budget.lift()
+            end_stream(optimize_queue, optimizers)
+            if options.dedup:
+                end_stream(dedup_queue, 1)
+            end_stream(upload_queue, workers)
+
+def get_optimize_pool():
+    """The process pool optimizing photos, started on first use and shared by all albums."""
+    global optimize_pool
+    with optimize_pool_lock:
+        if optimize_pool is None:
+            optimize_pool = ProcessPoolExecutor(max_workers=max(1, OPTIMIZE_PROCESSES),
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return optimize_pool
+
+def shutdown_optimize_pool():
+    # Its processes would otherwise keep the interpreter, or a claim worker process, from exiting
+    global optimize_pool
+    with optimize_pool_lock:
+        if optimize_pool is not None:
+            optimize_pool.shutdown()
+            optimize_pool = None
+
+def end_stream(source, consumers):
+    """Put an end marker for each consumer of source without blocking.
+
+    Only when a stage stopped with an error can the queue still be full; the photos
+    it holds are dropped, as the album is given up anyway.
+    """
+    for _ in range(consumers):
+        while True:
+            try:
+                source.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    source.get_nowait()
+                except queue.Empty:
+                    pass
+
+def next_batch(source, size):
+    """Wait for an item from source, then take up to size items in all.
+
+    Returns (batch, finished); a None item marks the end of the stream and is not
+    included in the batch.
+    """
+    batch = [source.get()]
+    while batch[-1] is not None and len(batch) < size:
+        try:
+            batch.append(source.get(timeout=BATCH_WAIT))
+        except queue.Empty:
+            break
+    if batch[-1] is None:
+        batch.pop()
+        return batch, True
+    return batch, False
+
+class PhotoFlags:
+    """Downloaded/uploaded flags waiting to be written, committed together in one transaction.
+
+    Files of uploaded photos are deleted, with options.delete_uploaded, only once their
+    flag is committed.
+    """
+
+    def __init__(self, cursor, conn, budget, options):
+        self.cursor = cursor
+        self.conn = conn
+        self.budget = budget
+        self.options = options
+        self.downloaded = []
+        self.uploaded = []  # (photo id, path, size, md5sum); no path for duplicate rows
+
+    def __len__(self):
+        return len(self.downloaded) + len(self.uploaded)
+
+    def flush(self):
+        if not self:
+            return
+        with metrics.stage('db_commit'):
+            if self.downloaded:
+                set_photo_flag(self.cursor, 'downloaded', self.downloaded)
+            if self.uploaded:
+                record_uploads(self.cursor, [(md5sum, photo_id) for photo_id, _, _, md5sum in self.uploaded])
+            self.conn.commit()
+        for _, photo_path, size, _ in self.uploaded:
+            if photo_path is None:
+                continue
+            if self.options.delete_uploaded:
+                try:
+                    os.remove(photo_path)
+                except OSError as e:
+                    logger.warning(f"Could not delete uploaded photo {photo_path}: {e}")
+                self.budget.finish(size)
+            else:
+                self.budget.finish()
+        self.downloaded.clear()
+        self.uploaded.clear()
+
+def record_photo_events(events, cursor, conn, budget, options, futures=(), lost=None):
+    """Write the flags reported by the pipeline workers until every listed photo is finished.
+
+    Flags are committed in batches of FLAG_BATCH_SIZE, or sooner when no event has come
+    for BATCH_WAIT seconds. Returns the number of photos that failed, counting a failed
+    listing as one. If one of the workers running as futures dies, the photos it would
+    have finished never report, so the unfinished photos are counted as failed instead.
+    Duplicate rows, with the file name of a photo listed before them, finish as that
+    photo does. When the lost event is set, recording stops and the photos not finished
+    yet are counted as failed; the flags of those already uploaded are still written.
+    """
+    flags = PhotoFlags(cursor, conn, budget, options)
+    finished = 0
+    failed = 0
+    listed = None  # Known once the listing is done
+    outcomes = {}  # File name -> ('uploaded' or 'failed', md5sum uploaded)
+    duplicates = {}  # File name -> duplicate rows waiting for its outcome
+    try:
+        while listed is None or finished < listed:
+            if lost is not None and lost.is_set():
+                logger.error("Lost the claim on the album, stopping its photo workers")
+                return failed + max(1, (listed or 0) - finished)
+            try:
+                event, photo, photo_path, size = events.get(timeout=BATCH_WAIT)
+            except queue.Empty:
+                flags.flush()
+                crashed = [future.exception() for future in futures if future.done() and future.exception()]
+                if crashed:
+                    logger.error(f"A photo worker stopped with an error, giving up on the rest of the album: {crashed[0]!r}")
+                    return failed + max(1, (listed or 0) - finished)
+                continue
+            if event == 'listed':
+                listed = size
+            elif event == 'listing_failed':
+                failed += 1
+            elif event == 'downloaded':
+                flags.downloaded.append(photo['id'])
+            settled = []
+            if event in ('failed', 'uploaded'):
+                outcomes[photo['filename']] = event, photo.get('md5sum')
+                settled = [(photo, photo_path, size)]
+                settled += [(dict(duplicate, md5sum=photo.get('md5sum')), None, 0)
+                            for duplicate in duplicates.pop(photo['filename'], [])]
+            elif event == 'duplicate':
+                if photo['filename'] in outcomes:
+                    event, md5sum = outcomes[photo['filename']]
+                    settled = [(dict(photo, md5sum=md5sum), None, 0)]
+                else:
+                    duplicates.setdefault(photo['filename'], []).append(photo)
+            for settled_photo, settled_path, settled_size in settled:
+                finished += 1
+                if event == 'failed':
+                    failed += 1
+                    metrics.count('photos_failed')
+                else:
+                    flags.uploaded.append((settled_photo['id'], settled_path, settled_size, settled_photo.get('md5sum')))
+                    metrics.count('photos')
+            if len(flags) >= FLAG_BATCH_SIZE:
+                flags.flush()
+    finally:
+        flags.flush()
+    return failed
+
+def photo_source(album_name, filename):
+    """Where to read a photo for verification: the optimized copy if there is one, the
+    Gallery original if it is on disk, the downloaded copy, or else its Gallery URL."""
+    optimized_path = os.path.join(OPTIMIZED_DIR, album_name, filename)
+    if os.path.exists(optimized_path):
+        return optimized_path
+    photo_url = f"{GALLERY_BASE_URL}/{album_name}/{filename}"
+    if is_local(photo_url):
+        return local_path(photo_url)
+    photo_path = os.path.join(DOWNLOAD_DIR, album_name, filename)
+    if os.path.exists(photo_path):
+        return photo_path
+    return photo_url
+
+def source_md5(source):
+    """md5sum of a file or URL, or None if it cannot be read. Runs in the verify process pool."""
+    try:
+        if not source.startswith(('http://', 'https://')):
+            return file_md5(source)
+        md5 = hashlib.md5()
+        with requests.get(source, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            for block in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                md5.update(block)
+        return md5.hexdigest()
+    except (OSError, requests.RequestException):
+        return None
+
+def piwigo_album_images(category_ids):
+    """The md5sums and file names of the images in each Piwigo album, read in bulk from the Piwigo database."""
+    md5sums = {category_id: set() for category_id in category_ids}
+    files = {category_id: set() for category_id in category_ids}
+    category_ids = list(category_ids)
+    with db_connection('piwigo') as pw_conn:
+        pw_cursor = pw_conn.cursor(dictionary=True)
+        for start in range(0, len(category_ids), VERIFY_BATCH_SIZE):
+            batch = category_ids[start:start + VERIFY_BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            with metrics.stage('db_query'):
+                pw_cursor.execute(f"SELECT ic.category_id, i.file, i.md5sum FROM {PW_DB_PREFIX}image_category ic "
+                                  f"JOIN {PW_DB_PREFIX}images i ON i.id = ic.image_id "
+                                  f"WHERE ic.category_id IN ({placeholders})", tuple(batch))
+                rows = pw_cursor.fetchall()
+            for row in rows:
+                md5sums[row['category_id']].add(row['md5sum'])
+                files[row['category_id']].add(row['file'])
+        pw_cursor.close()
+    return md5sums, files
+
+def reset_photos(photo_ids, album_ids, conn, cursor):
+    """Clear the flags of photos and their albums so that the next run migrates them again."""
+    photo_ids = list(photo_ids)
+    for start in range(0, len(photo_ids), VERIFY_BATCH_SIZE):
+        batch = photo_ids[start:start + VERIFY_BATCH_SIZE]
+        # The downloaded copy may be what is wrong, so it is fetched again too
+        set_photo_flag(cursor, 'downloaded', batch, False)
+        set_photo_flag(cursor, 'uploaded', batch, False)
+    placeholders = ', '.join(['%s'] * len(album_ids))
+    cursor.execute(f"UPDATE albums SET migrated=FALSE WHERE id IN ({placeholders})", tuple(album_ids))
+    conn.commit()
+
+def verify_albums(album_names, options):
+    """Check that the photos flagged as uploaded are in their Piwigo albums, byte for byte.
+
+    The md5sum of each photo, as recorded when it was uploaded or, for photos uploaded
+    before md5sums were recorded, as hashed in a pool of VERIFY_PROCESSES processes, is
+    looked up among the images of the photo's Piwigo album. A photo whose md5sum is not
+    there is reported as corrupt if the album has an image with its file name, and as
+    missing otherwise. With options.reset, the flags of those photos are cleared for a
+    re-run. Returns the number of missing and corrupt photos.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        scope = album_tree_ids(cursor, album_names) if album_names else None
+        cursor.execute("SELECT id, name, title, created, piwigo_id FROM albums")
+        albums = {album['id']: album for album in cursor.fetchall() if scope is None or album['id'] in scope}
+        cursor.execute("SELECT id, album_id, filename, md5sum FROM photos WHERE uploaded = TRUE ORDER BY id")
+        photos = [photo for photo in cursor.fetchall() if photo['album_id'] in albums]
+        for album in albums.values():
+            if album['piwigo_id'] is None and album['created']:
+                album['piwigo_id'] = find_piwigo_album_by_title(album['title'])
+        md5sums, files = piwigo_album_images({album['piwigo_id'] for album in albums.values()
+                                              if album['piwigo_id'] is not None})
+        metrics.expect('photos_verified', len(photos))
+
+        counts = {}  # Album id -> {status: photos}
+        bad = []
+        sources = [photo_source(albums[photo['album_id']]['name'], photo['filename'])
+                   for photo in photos if not photo['md5sum']]
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max(1, VERIFY_PROCESSES), mp_context=context) as executor:
+            # In photo order, like sources
+            hashed = zip(sources, executor.map(source_md5, sources, chunksize=8))
+            for photo in photos:
+                album = albums[photo['album_id']]
+                piwigo_album_id = album['piwigo_id']
+                source, md5sum = (None, photo['md5sum']) if photo['md5sum'] else next(hashed)
+                if md5sum is None:
+                    status = 'unreadable'
+                    logger.warning(f"Could not read {source} to verify it")
+                elif md5sum in md5sums.get(piwigo_album_id, ()):
+                    status = 'ok'
+                else:
+                    status = 'corrupt' if photo['filename'] in files.get(piwigo_album_id, ()) else 'missing'
+                    logger.warning(f"Photo {album['name']}/{photo['filename']} is {status} in Piwigo")
+                    bad.append(photo)
+                album_counts = counts.setdefault(album['id'], {})
+                album_counts[status] = album_counts.get(status, 0) + 1
+                metrics.count('photos_verified')
+
+        for album_id, album_counts in sorted(counts.items(), key=lambda item: albums[item[0]]['name']):
+            summary = ', '.join(f"{album_counts.get(status, 0)} {status}"
+                                for status in ('ok', 'missing', 'corrupt', 'unreadable'))
+            logger.info(f"Album {albums[album_id]['name']}: {summary}")
+        if bad and options.reset:
+            reset_photos([photo['id'] for photo in bad], {photo['album_id'] for photo in bad}, conn, cursor)
+            logger.info(f"Cleared the flags of {len(bad)} photos, run the migration again to upload them")
+        cursor.close()
+    return len(bad)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Migrate a Gallery 1.x album to Piwigo")
+    parser.add_argument('album_names', nargs='*', metavar='album_name',
+                        help="Gallery root albums to migrate (with --claim or --verify, all collected albums if none are given)")
+    parser.add_argument('--workers', type=int, default=MIGRATION_WORKERS,
+                        help="Number of download and of upload worker threads")
+    parser.add_argument('--dedup', action='store_true', default=MIGRATION_DEDUP,
+                        help="Link photos Piwigo already has (same md5sum) to the album instead of uploading them again")
+    parser.add_argument('--delete-uploaded', action='store_true', default=MIGRATION_DELETE_UPLOADED,
+                        help="Delete downloaded files once they are uploaded")
+    parser.add_argument('--disk-budget', type=int, default=MIGRATION_DISK_BUDGET_MB,
+                        help="With --delete-uploaded, megabytes of downloaded files to keep on disk at most (0 = no limit)")
+    parser.add_argument('--backend', choices=('ws', 'direct'), default=MIGRATION_BACKEND,
+                        help="Upload photos through ws.php, or copy them into PIWIGO_ROOT_DIR and the Piwigo database directly")
+    parser.add_argument('--claim', action='store_true',
+                        help="Claim albums one at a time from the migration database, so that several workers can share the work")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="With --claim, number of worker processes to start on this machine")
+    parser.add_argument('--optimize', action='store_true', default=MIGRATION_OPTIMIZE,
+                        help="Recompress photos, and strip their metadata but the capture dates, before uploading them (needs Pillow)")
+    parser.add_argument('--max-dimension', type=int, default=OPTIMIZE_MAX_DIMENSION,
+                        help="With --optimize, scale photos down to at most this many pixels wide and high (0 = keep the size)")
+    parser.add_argument('--verify', action='store_true',
+                        help="Check that uploaded photos are in Piwigo with the right md5sum instead of migrating")
+    parser.add_argument('--reset', action='store_true',
+                        help="With --verify, clear the flags of missing and corrupt photos so that the next run uploads them again")
+    return parser
 
 def main():
-    album_name = sys.argv[1]
-    process_album(album_name)
+    parser = build_parser()
+    options = parser.parse_args()
+    if options.backend == 'direct' and not PIWIGO_ROOT_DIR:
+        parser.error("--backend direct needs PIWIGO_ROOT_DIR")
+    if options.optimize and not pillow_available():
+        parser.error("--optimize needs Pillow (pip install Pillow)")
+    if options.verify:
+        with ProgressReporter('photos_verified'):
+            failed = verify_albums(options.album_names, options)
+        if failed:
+            sys.exit(1)
+    elif not options.claim:
+        if not options.album_names:
+            parser.error("an album name is required unless --claim is given")
+        try:
+            with ProgressReporter('photos', 'bytes_downloaded'):
+                for album_name in options.album_names:
+                    process_album(album_name, options)
+        finally:
+            shutdown_optimize_pool()
+    elif options.processes > 1:
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=run_claim_worker, args=(options.album_names, options))
+                     for _ in range(options.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        run_claim_worker(options.album_names, options)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,111 @@
+"""Helpers for the PHP-serialized data files and text of Gallery 1.x."""
+
+import re
+
+CHAR_MAP = {
+    '\\xC4': 'Ä',
+    '\\xE4': 'ä',
+    '\\xD6': 'Ö',
+    '\\xF6': 'ö',
+    '\\xC5': 'Å',
+    '\\xE5': 'å',
+    '\udcc4': 'Ä',
+    '\udce4': 'ä',
+    '\udcd6': 'Ö',
+    '\udcf6': 'ö',
+    '\udcc5': 'Å',
+    '\udce5': 'å'
+}
+CHAR_PATTERN = re.compile('|'.join(re.escape(key) for key in CHAR_MAP.keys()))
+
+def decode_chars(text):
+    if text is None:
+        return ''
+    return CHAR_PATTERN.sub(lambda x: CHAR_MAP[x.group()], text)
+
+# Type tags, compared as ints since indexing bytes and mmap objects returns ints
+N, I, B, D, S, A, O = b'NibdsaO'
+SCALARS = (I, B, D)
+
+def _find(data, char, pos):
+    end = data.find(char, pos)
+    if end < 0:
+        raise ValueError(f"Truncated serialized data, no {char!r} after offset {pos}")
+    return end
+
+def _expect(data, pos, token):
+    if data[pos:pos + len(token)] != token:
+        raise ValueError(f"Expected {token!r} at offset {pos}, got {bytes(data[pos:pos + len(token)])!r}")
+
+def _parse_string(data, pos):
+    # Parses the length-prefixed, quoted string at pos, whose type tag is already known
+    colon = _find(data, b':', pos + 2)
+    start = colon + 2
+    end = start + int(data[pos + 2:colon])
+    _expect(data, colon, b':"')
+    _expect(data, end, b'"')
+    return data[start:end].decode('utf-8', errors='surrogateescape'), end
+
+def _parse_value(data, pos, object_hook):
+    """Parse the serialized value starting at pos and return (value, position after it).
+
+    Strings are decoded as UTF-8 with surrogateescape, so Latin-1 bytes in old Gallery
+    data turn into the surrogates decode_chars knows about instead of failing the file.
+    Truncated or malformed data raises ValueError, like phpserialize.
+    """
+    if pos >= len(data):
+        raise ValueError(f"Truncated serialized data at offset {pos}")
+    kind = data[pos]
+    if kind == N:
+        _expect(data, pos, b'N;')
+        return None, pos + 2
+    if kind in SCALARS:
+        end = _find(data, b';', pos)
+        raw = data[pos + 2:end]
+        if kind == I:
+            value = int(raw)
+        elif kind == B:
+            value = raw == b'1'
+        else:
+            value = float(raw)
+        return value, end + 1
+    if kind == S:
+        value, end = _parse_string(data, pos)
+        _expect(data, end, b'";')
+        return value, end + 2
+    if kind == A or kind == O:
+        name = None
+        if kind == O:
+            name, pos = _parse_string(data, pos)  # At the closing quote, laid out like "a:"
+        colon = _find(data, b':', pos + 2)
+        count = int(data[pos + 2:colon])
+        _expect(data, colon, b':{')
+        pos = colon + 2
+        result = {}
+        for _ in range(count):
+            key, pos = _parse_value(data, pos, object_hook)
+            result[key], pos = _parse_value(data, pos, object_hook)
+        _expect(data, pos, b'}')
+        if name is not None and object_hook is not None:
+            result = object_hook(name, result)
+        return result, pos + 1
+    raise ValueError(f"Unexpected serialized type {chr(kind)!r} at offset {pos}")
+
+def iter_serialized_array(data, object_hook=None):
+    """Yield (key, value) for each entry of a serialized top-level PHP array.
+
+    Entries are decoded one at a time straight from the bytes-like buffer (bytes or an
+    mmap), so a large photos.dat never has to exist as one nested dict. A truncated
+    buffer raises ValueError once the entries before the damage are yielded.
+    """
+    if data[0:2] != b'a:':
+        raise ValueError(f"Expected a serialized array, got {bytes(data[0:20])!r}")
+    colon = _find(data, b':', 2)
+    count = int(data[2:colon])
+    _expect(data, colon, b':{')
+    pos = colon + 2
+    for _ in range(count):
+        key, pos = _parse_value(data, pos, object_hook)
+        value, pos = _parse_value(data, pos, object_hook)
+        yield key, value
+    _expect(data, pos, b'}')
@@ -0,0 +1,66 @@
+"""Read Gallery 1.x album files over HTTP or straight from a local albums directory.
+
+When Gallery runs on the same machine, or its ``albums/`` directory is mounted over NFS,
+set ``GALLERY_ALBUMS_DIR`` (or use a ``file://`` ``GALLERY_BASE_URL``) and both scripts
+read ``photos.dat``/``album.dat`` and the images from disk instead of the web server.
+"""
+
+import os
+import mmap
+import shutil
+import logging
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+logger = logging.getLogger(__name__)
+
+# Hard-link images into the download directory when it is on the same filesystem
+GALLERY_LINK_IMAGES = os.getenv('GALLERY_LINK_IMAGES', 'true').lower() in ('1', 'true', 'yes')
+
+def gallery_base_url():
+    albums_dir = os.getenv('GALLERY_ALBUMS_DIR', None)
+    if albums_dir:
+        return Path(albums_dir).resolve().as_uri()
+    return os.getenv('GALLERY_BASE_URL', None)
+
+def is_local(url):
+    return url.startswith('file://')
+
+def local_path(url):
+    return url2pathname(urlparse(url).path)
+
+def read_local_data(url):
+    """Memory-map a local file read-only.
+
+    The returned mmap supports the buffer protocol, so it can be handed to the parsers
+    and hashed without copying the file into a bytes object first.
+    """
+    path = local_path(url)
+    logger.debug("Reading local file: %s", path)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def copy_local_image(url, filepath):
+    """Put a local Gallery image at filepath, hard-linking it when possible.
+
+    The link or copy is made under a temporary name and renamed into place, so a file
+    at filepath is always complete. Callers must never modify the result in place since
+    a hard link shares its data with the Gallery original.
+    """
+    source = local_path(url)
+    part_path = filepath + '.part'
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    if GALLERY_LINK_IMAGES:
+        try:
+            os.link(source, part_path)
+        except OSError as e:
+            logger.debug("Cannot hard-link %s, copying instead: %s", source, e)
+            shutil.copyfile(source, part_path)
+    else:
+        shutil.copyfile(source, part_path)
+    os.replace(part_path, filepath)
+    logger.debug("Copied local image %s to %s", source, filepath)
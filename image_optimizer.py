@@ -0,0 +1,165 @@
+"""Optional optimization of downloaded photos before they are uploaded to Piwigo.
+
+``optimize_image`` writes a smaller copy of a JPEG or PNG to a new file; the source may
+be a hard link to the Gallery original and is never modified. JPEGs are only decoded
+and re-encoded when they are resized; stripping their metadata rewrites the file's
+segments and keeps the compressed image data as it is. It needs Pillow, which
+is only imported when available. ``sniff_mime_type`` tells the upload what a file
+really is from its first bytes, since Gallery file extensions are not always right.
+"""
+
+import os
+import struct
+import logging
+import mimetypes
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Only --optimize needs Pillow
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+EXIF_IFD = 0x8769
+# Capture dates kept when the rest of the metadata is stripped: DateTime in IFD0, and
+# DateTimeOriginal, DateTimeDigitized and their time zone offsets in the Exif IFD
+DATE_TAGS = (0x0132,)
+ORIENTATION_TAG = 0x0112
+EXIF_DATE_TAGS = (0x9003, 0x9004, 0x9010, 0x9011, 0x9012)
+
+MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'BM', 'image/bmp'),
+)
+
+def pillow_available():
+    return Image is not None
+
+def sniff_mime_type(filepath):
+    """MIME type of an image from its magic bytes, falling back to its extension."""
+    with open(filepath, 'rb') as f:
+        head = f.read(12)
+    for magic, mime_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+
+def date_exif(image, keep_orientation=False):
+    """A new EXIF block with only the capture dates of image, and its orientation if asked."""
+    exif = image.getexif()
+    kept = Image.Exif()
+    for tag in DATE_TAGS + ((ORIENTATION_TAG,) if keep_orientation else ()):
+        if tag in exif:
+            kept[tag] = exif[tag]
+    exif_ifd = exif.get_ifd(EXIF_IFD)
+    dates = {tag: exif_ifd[tag] for tag in EXIF_DATE_TAGS if tag in exif_ifd}
+    if dates:
+        kept[EXIF_IFD] = dates
+    return kept
+
+def jpeg_segments(data):
+    """Yield (marker, segment bytes) for the segments of a JPEG up to its first SOS marker,
+    then (SOS marker, rest of the file)."""
+    pos = 2  # After SOI
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError(f"Expected a JPEG marker at offset {pos}")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker == 0xDA:
+            yield marker, data[pos:]
+            return
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        yield marker, data[pos:pos + 2 + length]
+        pos += 2 + length
+    raise ValueError("JPEG ends before its image data")
+
+def strip_jpeg_metadata(source, target, exif_bytes):
+    """Copy the JPEG at source to target without its metadata segments, adding exif_bytes.
+
+    JFIF (APP0), ICC profile (APP2) and Adobe (APP14) segments are kept since they tell how
+    to decode the colours; other application segments and comments are dropped. The
+    compressed image data is copied as it is.
+    """
+    with open(source, 'rb') as f:
+        data = f.read()
+    kept = [b'\xff\xd8']
+    exif_segment = b'\xff\xe1' + struct.pack('>H', len(exif_bytes) + 2) + exif_bytes if exif_bytes else b''
+    for marker, segment in jpeg_segments(data):
+        if marker == 0xE0 or (marker == 0xE2 and segment[4:16] == b'ICC_PROFILE\x00') or marker == 0xEE:
+            kept.append(segment)
+        elif 0xE0 <= marker <= 0xEF or marker == 0xFE:
+            continue
+        else:
+            kept.append(exif_segment)  # After JFIF, which has to come first
+            exif_segment = b''
+            kept.append(segment)
+    with open(target, 'wb') as f:
+        f.write(b''.join(kept))
+
+def optimize_image(source, target, max_dimension=0, jpeg_quality=90, strip_metadata=True):
+    """Write an optimized copy of the JPEG or PNG at source to target.
+
+    Images larger than max_dimension (0 for no limit) are scaled down and saved at
+    jpeg_quality, with the EXIF orientation applied to the pixels. PNGs are recompressed
+    losslessly; other JPEGs are never re-encoded, only their metadata is stripped. With
+    strip_metadata, only the EXIF capture dates, the orientation of images that are not
+    rotated and the colour profile are kept. Returns True if target was written, or False
+    if the source should be uploaded as it is: it is not a JPEG or PNG, or the copy would
+    not be smaller and no resize was needed.
+    """
+    part_path = target + '.part'
+    with Image.open(source) as original:
+        if original.format not in ('JPEG', 'PNG'):
+            return False
+        resized = bool(max_dimension) and max(original.size) > max_dimension
+        if original.format == 'JPEG' and not resized:
+            if not strip_metadata:
+                return False
+            exif = date_exif(original, keep_orientation=True)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            strip_jpeg_metadata(source, part_path, exif.tobytes() if len(exif) else b'')
+            return keep_if_smaller(source, target, part_path)
+        params = {'optimize': True}
+        for key in ('icc_profile', 'transparency'):
+            if key in original.info:
+                params[key] = original.info[key]
+        if strip_metadata:
+            exif = date_exif(original)
+            image = ImageOps.exif_transpose(original)
+        else:
+            exif = original.getexif()
+            image = original
+        if len(exif):
+            params['exif'] = exif.tobytes()
+        if resized:
+            image = image.copy()
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        if original.format == 'JPEG':
+            params['quality'] = jpeg_quality
+            if image.mode not in ('RGB', 'L', 'CMYK'):
+                image = image.convert('RGB')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        image.save(part_path, original.format, **params)
+    if resized:
+        os.replace(part_path, target)
+        logger.debug("Optimized %s to %s (%s bytes)", source, target, os.path.getsize(target))
+        return True
+    return keep_if_smaller(source, target, part_path)
+
+def keep_if_smaller(source, target, part_path):
+    if os.path.getsize(part_path) >= os.path.getsize(source):
+        os.remove(part_path)
+        return False
+    os.replace(part_path, target)
+    logger.debug("Optimized %s to %s (%s bytes)", source, target, os.path.getsize(target))
+    return True
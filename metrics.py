@@ -0,0 +1,146 @@
+"""Counters, stage timers and progress reporting shared by the collection and migration scripts.
+
+Both scripts count items and bytes in the module-level ``metrics`` object and time their
+stages with ``metrics.stage(name)``. While a ``ProgressReporter`` runs, a progress line
+with rate and ETA is logged every ``PROGRESS_INTERVAL`` seconds and, if ``METRICS_FILE``
+is set, the metrics are written to it as JSON (``.json``) or in the Prometheus text
+format (anything else, e.g. ``.prom`` for node_exporter's textfile collector).
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', 10))
+METRICS_FILE = os.getenv('METRICS_FILE', None)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = {}
+        self.expected = {}
+        self.stages = {}  # Stage name -> [calls, seconds]
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def expect(self, name, amount):
+        """Add to the number of items the run is expected to count under name, for the ETA."""
+        with self.lock:
+            self.expected[name] = self.expected.get(name, 0) + amount
+
+    def record(self, stage, seconds):
+        with self.lock:
+            calls_and_seconds = self.stages.setdefault(stage, [0, 0.0])
+            calls_and_seconds[0] += 1
+            calls_and_seconds[1] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'elapsed_seconds': round(time.monotonic() - self.started, 3),
+                'counters': dict(self.counters),
+                'expected': dict(self.expected),
+                'stages': {name: {'calls': calls, 'seconds': round(seconds, 3)}
+                           for name, (calls, seconds) in self.stages.items()},
+            }
+
+    def progress(self, item, bytes_counter=None):
+        """One line with items done, rate, throughput and, when the total is known, the ETA."""
+        snapshot = self.snapshot()
+        elapsed = max(snapshot['elapsed_seconds'], 1e-9)
+        done = snapshot['counters'].get(item, 0)
+        total = snapshot['expected'].get(item)
+        rate = done / elapsed
+        line = f"{done}/{total} {item}" if total else f"{done} {item}"
+        line += f" ({rate:.1f}/s"
+        if bytes_counter:
+            line += f", {snapshot['counters'].get(bytes_counter, 0) / elapsed / 1024 / 1024:.1f} MB/s"
+        line += ")"
+        if total and rate > 0:
+            line += f" ETA {timedelta(seconds=round(max(total - done, 0) / rate))}"
+        return line
+
+    def write(self, path, prefix):
+        snapshot = self.snapshot()
+        if path.endswith('.json'):
+            text = json.dumps(snapshot, indent=2, sort_keys=True) + '\n'
+        else:
+            lines = [
+                f"# TYPE {prefix}_elapsed_seconds gauge",
+                f"{prefix}_elapsed_seconds {snapshot['elapsed_seconds']}",
+                f"# TYPE {prefix}_items_total counter",
+            ]
+            lines += [f'{prefix}_items_total{{counter="{name}"}} {value}'
+                      for name, value in sorted(snapshot['counters'].items())]
+            lines.append(f"# TYPE {prefix}_items_expected gauge")
+            lines += [f'{prefix}_items_expected{{counter="{name}"}} {value}'
+                      for name, value in sorted(snapshot['expected'].items())]
+            lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+            lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {stage["calls"]}'
+                      for name, stage in sorted(snapshot['stages'].items())]
+            lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+            lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {stage["seconds"]}'
+                      for name, stage in sorted(snapshot['stages'].items())]
+            text = '\n'.join(lines) + '\n'
+        # Replace the file in one step so that readers never see half of it
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+metrics = Metrics()
+
+def process_metrics_file():
+    """METRICS_FILE with the process id before the extension, for runs with several processes."""
+    if not METRICS_FILE:
+        return None
+    root, extension = os.path.splitext(METRICS_FILE)
+    return f"{root}.{os.getpid()}{extension}"
+
+class ProgressReporter:
+    """Logs progress and writes the metrics file periodically while the with block runs."""
+
+    def __init__(self, item, bytes_counter=None, prefix='gallery_migration', path=METRICS_FILE):
+        self.item = item
+        self.bytes_counter = bytes_counter
+        self.prefix = prefix
+        self.path = path
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+    def run(self):
+        while not self.stopped.wait(PROGRESS_INTERVAL):
+            self.report()
+
+    def report(self):
+        logger.info(f"Progress: {metrics.progress(self.item, self.bytes_counter)}")
+        if self.path:
+            try:
+                metrics.write(self.path, self.prefix)
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {self.path}: {e}")
@@ -0,0 +1,154 @@
+"""Access to the migration database for both scripts, on MySQL or on an embedded SQLite file.
+
+``DATABASE_URL`` is a SQLAlchemy URL. The collection script uses it through SQLAlchemy;
+the migration script gets DB-API connections from a small pool: mysql.connector for
+MySQL, or for a ``sqlite:///`` URL a wrapper around sqlite3 that accepts the same
+``%s`` placeholders and ``cursor(dictionary=True)``. SQLite files are used in WAL mode,
+so a single-machine migration needs no database server and a commit costs a local
+write instead of a network round trip.
+"""
+
+import queue
+import sqlite3
+import logging
+from datetime import datetime
+from mysql.connector import pooling
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+SQLITE_TIMEOUT = 60  # Seconds to wait for another connection's write lock
+
+# Stored the way SQLAlchemy stores DateTime columns in SQLite, so they compare as text
+sqlite3.register_adapter(datetime, lambda value: value.strftime('%Y-%m-%d %H:%M:%S.%f'))
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
+def is_sqlite(url):
+    return url is not None and make_url(url).get_backend_name() == 'sqlite'
+
+def configure_sqlite(connection):
+    connection.execute('PRAGMA journal_mode=WAL')
+    # In WAL mode NORMAL syncs at checkpoints only: a crash can lose the latest commits,
+    # which the migration redoes, but cannot corrupt the database
+    connection.execute('PRAGMA synchronous=NORMAL')
+
+def create_db_engine(url):
+    """SQLAlchemy engine for url, with SQLite files switched to WAL mode."""
+    if not is_sqlite(url):
+        return create_engine(url)
+    engine = create_engine(url, connect_args={'timeout': SQLITE_TIMEOUT, 'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        configure_sqlite(dbapi_connection)
+        # sqlite3 would begin transactions on its own and break savepoints; SQLAlchemy does it instead
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+    return engine
+
+class SQLiteCursor:
+    def __init__(self, connection, dictionary):
+        self.cursor = connection.cursor()
+        self.dictionary = dictionary
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query.replace('%s', '?'), tuple(params or ()))
+        self.rowcount, self.lastrowid = self.cursor.rowcount, self.cursor.lastrowid
+
+    def executemany(self, query, seq_of_params):
+        self.cursor.executemany(query.replace('%s', '?'), seq_of_params)
+        self.rowcount = self.cursor.rowcount
+
+    def row(self, values):
+        if values is None or not self.dictionary:
+            return values
+        return dict(zip((column[0] for column in self.cursor.description), values))
+
+    def fetchone(self):
+        return self.row(self.cursor.fetchone())
+
+    def fetchall(self):
+        return [self.row(values) for values in self.cursor.fetchall()]
+
+    def __iter__(self):
+        return (self.row(values) for values in self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+class SQLiteConnection:
+    """A pooled sqlite3 connection; close() hands it back to the pool like mysql.connector's."""
+
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+
+    def cursor(self, dictionary=False):
+        return SQLiteCursor(self.connection, dictionary)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.rollback()  # Like a MySQL pool reset, drop anything left uncommitted
+        try:
+            self.pool.idle.put_nowait(self.connection)
+        except queue.Full:
+            self.connection.close()
+
+class SQLitePool:
+    def __init__(self, path, pool_size):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=pool_size)
+
+    def get_connection(self):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, check_same_thread=False,
+                                         detect_types=sqlite3.PARSE_DECLTYPES)
+            configure_sqlite(connection)
+        return SQLiteConnection(self, connection)
+
+def mysql_config(url):
+    url = make_url(url)
+    config = {'host': url.host, 'user': url.username, 'password': url.password, 'database': url.database}
+    if url.port:
+        config['port'] = url.port
+    return config
+
+def create_pool(name, pool_size, url=None, config=None):
+    """Connection pool for url if given, otherwise for the mysql.connector settings in config."""
+    if is_sqlite(url):
+        logger.info(f"Using SQLite database {make_url(url).database} for {name}")
+        return SQLitePool(make_url(url).database, pool_size)
+    if url is not None:
+        config = mysql_config(url)
+    return pooling.MySQLConnectionPool(pool_name=name, pool_size=pool_size, **config)
+
+def set_photo_flag(cursor, column, photo_ids, value=True):
+    """Set, or clear, the downloaded or uploaded flag of many photos with one statement."""
+    placeholders = ', '.join(['%s'] * len(photo_ids))
+    cursor.execute(f"UPDATE photos SET {column}={'TRUE' if value else 'FALSE'} WHERE id IN ({placeholders})",
+                   tuple(photo_ids))
+
+def record_uploads(cursor, uploads):
+    """Set the uploaded flag of many photos and record the md5sum Piwigo got, given as (md5sum, photo id).
+
+    One statement for the whole batch: mysql.connector's executemany only batches INSERTs.
+    """
+    cases = ' '.join(['WHEN %s THEN %s'] * len(uploads))
+    placeholders = ', '.join(['%s'] * len(uploads))
+    params = [value for md5sum, photo_id in uploads for value in (photo_id, md5sum)]
+    cursor.execute(f"UPDATE photos SET uploaded=TRUE, md5sum=CASE id {cases} END WHERE id IN ({placeholders})",
+                   tuple(params + [photo_id for _, photo_id in uploads]))
@@ -0,0 +1,128 @@
+"""Client for the Piwigo web API (ws.php) shared by all migration threads."""
+
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from xml.etree import ElementTree
+from request_scheduler import REQUEST_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Methods that create something, so that a request that may have been processed is not repeated
+NON_IDEMPOTENT_METHODS = ('pwg.categories.add', 'pwg.images.addSimple', 'pwg.images.add')
+
+class PiwigoError(Exception):
+    def __init__(self, method, code, message):
+        super().__init__(f"{method} failed: {message} (code {code})")
+        self.method = method
+        self.code = code
+
+class PiwigoClient:
+    """Logs in once and re-authenticates transparently when the session expires.
+
+    Every thread gets its own keep-alive requests session; the login cookies are kept
+    here and copied into a thread's session before each call. Piwigo answers an expired
+    session with err code 401, in which case the client logs in again (only once for
+    all threads that notice at the same time) and repeats the call. With a scheduler,
+    requests are sent through it, which retries overloaded or unreachable servers.
+    """
+
+    def __init__(self, api_url, username, password, pool_size=2, scheduler=None, timeout=REQUEST_TIMEOUT):
+        self.api_url = api_url
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.generation = 0  # Number of successful logins so far
+        self.login_lock = threading.Lock()
+        self.local = threading.local()
+
+    def http_session(self):
+        http_session = getattr(self.local, 'session', None)
+        if http_session is None:
+            http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            http_session.mount('http://', adapter)
+            http_session.mount('https://', adapter)
+            self.local.session = http_session
+        http_session.cookies.update(self.cookies)
+        return http_session
+
+    def _send(self, data, params=None, files=None):
+        for file_spec in (files or {}).values():
+            file_spec[1].seek(0)  # A retried upload has to send the file from the start
+        response = self.http_session().post(self.api_url, params=params, data=data, files=files, timeout=self.timeout)
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        return response
+
+    def _post(self, data, params=None, files=None):
+        if self.scheduler is None:
+            return self._send(data, params, files)
+        method = data.get('method')
+        # Uploads take as long as their file needs, so only their failures tell about the server
+        return self.scheduler.call(self._send, data, params, files, latency_key=None if files else method,
+                                   idempotent=method not in NON_IDEMPOTENT_METHODS)
+
+    def _login(self):
+        data = {
+            'method': 'pwg.session.login',
+            'username': self.username,
+            'password': self.password,
+        }
+        response = self._post(data)
+        logger.debug("Login response status code: %s", response.status_code)
+        if logger.isEnabledFor(logging.DEBUG):  # Decoding the body is not free
+            logger.debug("Login response text: %s", response.text)
+        result = ElementTree.fromstring(response.content)
+        if result.get('stat') != 'ok':
+            raise Exception("Failed to log in to Piwigo")
+        self.cookies.update(self.http_session().cookies)
+        self.generation += 1
+        logger.debug("Logged in to Piwigo")
+
+    def _ensure_login(self, expired_generation=None):
+        # Returns the login generation the caller's request runs under
+        with self.login_lock:
+            if self.generation == 0 or self.generation == expired_generation:
+                self._login()
+            return self.generation
+
+    def call(self, method, data=None, files=None, response_format='rest'):
+        """POST a ws.php method and return its result, raising PiwigoError on failure.
+
+        The result is the parsed <rsp> element, or with response_format='json' the decoded
+        'result' value; JSON suits methods such as pwg.images.exist whose result keys are
+        not valid XML element names.
+        """
+        payload = dict(data or {}, method=method)
+        params = {'format': response_format} if response_format != 'rest' else None
+        generation = self._ensure_login()
+        for attempt in (1, 2):
+            response = self._post(payload, params, files)
+            logger.debug("%s response status code: %s", method, response.status_code)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s response text: %s", method, response.text)
+            try:
+                if response_format == 'json':
+                    result = response.json()
+                    stat, code, message = result.get('stat'), result.get('err'), result.get('message')
+                    result = result.get('result')
+                else:
+                    result = ElementTree.fromstring(response.content)
+                    error = result.find('err')
+                    stat = result.get('stat')
+                    code = error.get('code') if error is not None else None
+                    message = error.get('msg', error.text) if error is not None else response.text
+            except (ValueError, ElementTree.ParseError):
+                response.raise_for_status()
+                raise PiwigoError(method, response.status_code, f"response is not {response_format}")
+            if stat == 'ok':
+                return result
+            if str(code) != '401' or attempt == 2:
+                raise PiwigoError(method, code, message)
+            logger.info(f"Piwigo session expired during {method}, logging in again")
+            generation = self._ensure_login(expired_generation=generation)
@@ -0,0 +1,114 @@
+"""Bulk import of photos straight into Piwigo's storage and database, bypassing ws.php.
+
+Files are placed in Piwigo's ``upload/YYYY/MM/DD/`` layout and registered with batched
+inserts into the images and image_category tables. Thumbnails and other derivatives
+are not built here; Piwigo creates them on first request.
+"""
+
+import os
+import math
+import shutil
+import struct
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+def image_size(filepath):
+    """Return (width, height) of a JPEG, PNG or GIF file, or (None, None) if unknown."""
+    with open(filepath, 'rb') as f:
+        head = f.read(26)
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head.startswith(b'\xff\xd8'):
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    break
+                if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                length = f.read(2)
+                if len(length) < 2:
+                    break
+                # Start-of-frame markers carry the dimensions; C4, C8 and CC are not frames
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    frame = f.read(5)
+                    if len(frame) < 5:
+                        break
+                    height, width = struct.unpack('>xHH', frame)
+                    return width, height
+                f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+    return None, None
+
+class DirectImporter:
+    """Imports photos into a Piwigo installation through its database connection.
+
+    ``conn`` is a DB-API connection to the Piwigo database (mysql.connector), ``root_dir``
+    the Piwigo installation directory holding ``upload/``. Both can point at a local
+    MySQL and a temporary directory for testing.
+    """
+
+    def __init__(self, conn, root_dir, prefix='piwigo_', added_by=1):
+        self.conn = conn
+        self.root_dir = root_dir
+        self.prefix = prefix
+        self.added_by = added_by
+
+    def place_file(self, source, md5sum, now):
+        """Copy source into the upload directory and return its Piwigo path ('./upload/...')."""
+        extension = os.path.splitext(source)[1].lower()
+        directory = os.path.join('upload', now.strftime('%Y'), now.strftime('%m'), now.strftime('%d'))
+        os.makedirs(os.path.join(self.root_dir, directory), exist_ok=True)
+        basename = f"{now.strftime('%Y%m%d%H%M%S')}-{md5sum[:8]}"
+        relative = os.path.join(directory, basename + extension)
+        suffix = 0
+        while os.path.exists(os.path.join(self.root_dir, relative)):
+            suffix += 1
+            relative = os.path.join(directory, f"{basename}-{suffix}{extension}")
+        shutil.copyfile(source, os.path.join(self.root_dir, relative))
+        return './' + relative.replace(os.sep, '/')
+
+    def import_photos(self, category_id, photos):
+        """Import a batch of photos into one category and return their new image ids.
+
+        Each photo is a dict with path, filename, name, comment, date_creation,
+        date_available and md5sum. The batch is committed as one transaction;
+        on failure it is rolled back and the files placed for it are removed.
+        """
+        now = datetime.now()
+        placed = []
+        rows = []
+        cursor = self.conn.cursor()
+        try:
+            for photo in photos:
+                path = self.place_file(photo['path'], photo['md5sum'], now)
+                placed.append(path)
+                width, height = image_size(photo['path'])
+                filesize = math.ceil(os.path.getsize(photo['path']) / 1024)
+                rows.append((photo['filename'], photo['name'], photo['comment'], path, filesize, width, height,
+                             photo['md5sum'], self.added_by, photo['date_creation'], photo['date_available']))
+            cursor.executemany(
+                f"INSERT INTO {self.prefix}images (file, name, comment, path, filesize, width, height, "
+                "md5sum, added_by, date_creation, date_available) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", rows)
+            placeholders = ', '.join(['%s'] * len(placed))
+            cursor.execute(f"SELECT id, path FROM {self.prefix}images WHERE path IN ({placeholders})", placed)
+            ids = {path: image_id for image_id, path in cursor.fetchall()}
+            image_ids = [ids[path] for path in placed]
+            cursor.executemany(f"INSERT INTO {self.prefix}image_category (image_id, category_id) VALUES (%s, %s)",
+                               [(image_id, category_id) for image_id in image_ids])
+            # Have Piwigo recompute album counts and permissions on the next page view
+            cursor.execute(f"UPDATE {self.prefix}user_cache SET need_update = 'true'")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            for path in placed:
+                os.remove(os.path.join(self.root_dir, path))
+            raise
+        finally:
+            cursor.close()
+        logger.info(f"Imported {len(image_ids)} photos into Piwigo category {category_id}")
+        return image_ids
@@ -0,0 +1,140 @@
+"""Retries with backoff and an adaptive concurrency limit for requests to Gallery and Piwigo.
+
+Each server gets one RequestScheduler shared by all threads talking to it. Requests
+failing with a connection error, a timeout, 429 or a 5xx status are retried after an
+exponentially growing, jittered delay; requests that are not safe to repeat, such as
+creating an album or an image, are only retried when they never reached the server.
+The number of requests allowed in flight follows AIMD: it grows by about one per
+window of successful requests and is halved when requests fail or time out, or when
+the latency of one kind of request climbs well above the best seen for that kind.
+Transfers whose time depends on their size (downloads, uploads) are only judged by
+their failures, so that a large file does not read as an overloaded server.
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+import requests
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+REQUEST_RETRIES = int(os.getenv('REQUEST_RETRIES', 4))
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 60))  # Seconds to connect, or between bytes received
+REQUEST_BACKOFF = float(os.getenv('REQUEST_BACKOFF', 0.5))  # Seconds before the first retry
+REQUEST_BACKOFF_MAX = float(os.getenv('REQUEST_BACKOFF_MAX', 30))
+# Latency this many times the best average seen counts as overload
+REQUEST_LATENCY_FACTOR = float(os.getenv('REQUEST_LATENCY_FACTOR', 3))
+LATENCY_SMOOTHING = 0.2
+BEST_LATENCY_DRIFT = 1.001
+
+def is_retryable(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+def never_sent(error):
+    """True if the request certainly did not reach the server, so repeating it is always safe."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429  # Rejected before being processed
+    if isinstance(error, requests.ConnectionError):
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+def retry_after(error):
+    # Seconds the server asked us to wait, if it did
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def checked_get(url, session=requests, **kwargs):
+    """GET url and raise HTTPError for error statuses, so that the scheduler sees them."""
+    kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+    response = session.get(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+class RequestScheduler:
+    def __init__(self, name, max_concurrency, min_concurrency=1, retries=REQUEST_RETRIES):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.retries = max(1, retries)
+        self.limit = float(self.max_concurrency)
+        self.active = 0
+        self.latencies = {}  # Kind of request -> [moving average of successful request times, best average]
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, elapsed, overloaded, latency_key=None):
+        with self.condition:
+            self.active -= 1
+            now = time.monotonic()
+            if not overloaded and latency_key is not None:
+                latency = self.latencies.get(latency_key)
+                if latency is None:
+                    latency = self.latencies[latency_key] = [elapsed, elapsed]
+                else:
+                    latency[0] = LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * latency[0]
+                    # The best average creeps up slowly, so that a lasting change in the server
+                    # does not read as overload forever
+                    latency[1] = min(latency[0], latency[1] * BEST_LATENCY_DRIFT)
+                overloaded = latency[0] > REQUEST_LATENCY_FACTOR * latency[1]
+            if overloaded:
+                # Halve at most once per round trip, a burst of failures is one congestion event
+                if now - self.last_decrease > elapsed and self.limit > self.min_concurrency:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.last_decrease = now
+                    logger.info(f"{self.name}: reducing concurrency to {int(self.limit)}")
+            elif self.limit < self.max_concurrency:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def backoff(self, attempt, error):
+        delay = retry_after(error)
+        if delay is None:
+            # Full jitter keeps workers that failed together from retrying together
+            delay = random.uniform(0, min(REQUEST_BACKOFF_MAX, REQUEST_BACKOFF * 2 ** (attempt - 1)))
+        return delay
+
+    def call(self, func, *args, latency_key=None, idempotent=True, **kwargs):
+        """Run func(*args, **kwargs) within the concurrency limit, retrying transient failures.
+
+        Requests with the same latency_key take comparable time, so a rise in their latency
+        means the server is overloaded; without one only failures count. A request that is
+        not idempotent is retried only if it never reached the server.
+        """
+        for attempt in range(1, self.retries + 1):
+            self.acquire()
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retryable = is_retryable(e)
+                self.release(time.monotonic() - start, overloaded=retryable)
+                if not idempotent and not never_sent(e):
+                    retryable = False
+                if not retryable or attempt == self.retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                logger.warning(f"{self.name}: attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.release(time.monotonic() - start, overloaded=False, latency_key=latency_key)
+            return result